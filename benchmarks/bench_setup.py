@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Times the setup plugins against simulated clusters:
+
+    $ python benchmarks/bench_setup.py --nodes 10,100,1000
+
+Each plugin's run() is driven through StarCluster's thread pool against a
+fakecluster.FakeCluster and the report shows total wall-clock, per-phase
+wall-clock (from the provisioning trace) and SSH operation counts. A run
+that hits a simulated failure is retried on the same cluster, the way a
+user would rerun the plugin, so --failure-rate also measures how much work
+the checkpoints save. Spark is timed with the prebuilt download and in
+both source build modes.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'plugins'))
+
+import fakecluster
+import tracing
+from myhadoop import HadoopInstaller
+from skylark_installer import SkylarkInstaller
+from sparkinstaller import SparkInstaller
+
+PLUGINS = {
+    'spark-binary': lambda: SparkInstaller(distribution='binary'),
+    'spark-master': lambda: SparkInstaller(build_mode='master', distribution='source'),
+    'spark-node': lambda: SparkInstaller(build_mode='node', distribution='source'),
+    'hadoop': lambda: HadoopInstaller(apt_proxy=False),
+    'skylark': lambda: SkylarkInstaller(apt_proxy=False),
+}
+
+
+def phase_times(events):
+    """
+    Wall-clock per round of pool jobs / install steps, in order of start. A
+    round is a run of overlapping events of one kind and name, so a phase
+    that comes round again later, e.g. a second probe of every node, is
+    reported as 'name #2' instead of stretching over everything in between
+    """
+    phases = []
+    current = {}
+    rounds = {}
+    for event in sorted(events, key=lambda e: e['ts']):
+        if event['cat'] not in ('job', 'step'):
+            continue
+        key = (event['cat'], event['name'])
+        start, end = event['ts'], event['ts'] + event['dur']
+        phase = current.get(key)
+        if phase is None or start > phase[2]:
+            rounds[key] = rounds.get(key, 0) + 1
+            name = event['name']
+            if rounds[key] > 1:
+                name = '%s #%d' % (name, rounds[key])
+            phase = current[key] = [name, start, end]
+            phases.append(phase)
+        else:
+            phase[2] = max(phase[2], end)
+    return [(label, (first, last)) for label, first, last in phases]
+
+
+def bench(name, num_nodes, options):
+    cluster = fakecluster.FakeCluster(
+        num_nodes, latency=options.latency, bandwidth=options.bandwidth,
+        failure_rate=options.failure_rate, time_scale=options.time_scale)
+    tracing.TRACER.reset()
+    tracing.enable(None)
+    plugin = PLUGINS[name]()
+    start = time.time()
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            plugin.run(cluster.nodes, cluster.master, 'sgeadmin', 'bash', {})
+            break
+        except Exception as e:
+            if attempts >= options.attempts:
+                print "%s on %d nodes gave up after %d attempts: %s" % (
+                    name, num_nodes, attempts, e)
+                break
+    elapsed = time.time() - start
+    plugin.pool.shutdown()
+
+    scale = options.time_scale
+    print "%s, %d nodes: %.1fs simulated (%d attempts, %d failures, %d swallowed)" % (
+        name, num_nodes, elapsed / scale, attempts, cluster.failures, cluster.swallowed)
+    print "  ssh ops: %d (%s), %.1f MB moved" % (
+        cluster.ssh_ops(),
+        ', '.join('%s %d' % item for item in sorted(cluster.counts.items())),
+        cluster.bytes / 1e6)
+    for phase, (first, last) in phase_times(tracing.TRACER.events()):
+        print "  %-28s %10.1fs" % (phase, (last - first) / 1e6 / scale)
+    if options.trace_dir:
+        tracing.TRACER.save(os.path.join(options.trace_dir,
+                                         'trace-%s-%d.json' % (name, num_nodes)))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--nodes', default='10,100,1000',
+                      help='comma separated cluster sizes')
+    parser.add_option('--plugins', default=','.join(sorted(PLUGINS)),
+                      help='comma separated subset of %s' % ', '.join(sorted(PLUGINS)))
+    parser.add_option('--latency', type='float', default=0.05,
+                      help='seconds per SSH round trip')
+    parser.add_option('--bandwidth', type='float', default=50e6,
+                      help='bytes per second per transfer')
+    parser.add_option('--failure-rate', type='float', default=0.0,
+                      help='probability that a remote command fails')
+    parser.add_option('--attempts', type='int', default=3,
+                      help='reruns allowed after a failed run')
+    parser.add_option('--time-scale', type='float', default=0.01,
+                      help='real seconds slept per simulated second; much '
+                           'smaller and Python overhead dominates the timings')
+    parser.add_option('--trace-dir',
+                      help='also write a Chrome trace per run to this directory')
+    options, args = parser.parse_args()
+    for num_nodes in [int(n) for n in options.nodes.split(',')]:
+        for name in options.plugins.split(','):
+            bench(name, num_nodes, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+from starcluster import exception
+
+import os
+import posixpath
+import random
+import re
+import threading
+import time
+
+from StringIO import StringIO
+
+# In-memory stand-ins for StarCluster's Node and SSHClient, so the setup
+# plugins can be driven at hundreds of nodes without EC2. Every remote
+# operation sleeps for a round trip plus its transfer time at the simulated
+# bandwidth, long-running commands (builds, apt-get, downloads) sleep for a
+# nominal cost, and a configurable fraction of commands fail. A command line
+# fails or not the way bash would run it: each simple command in it can fail
+# on its own, '&&', '||' and set -e decide what runs next, and the line exits
+# with the status of the last command run, so failures that a ';' swallows
+# are counted as such. All times are multiplied by time_scale so a simulated
+# hour-long setup runs in seconds.
+
+# nominal seconds for the commands that dominate a real setup; the first
+# matching pattern wins
+COMMAND_COSTS = [
+    (r'make-distribution\.sh|build/mvn|mvn ', 900),
+    (r'make -j|cmake --build|\./b2 ', 300),
+    (r'configure ', 60),
+    (r'apt-get .*install', 120),
+    (r'apt-get .*update', 20),
+    (r'dpkg-deb|dpkg-scanpackages|dpkg -i', 10),
+    (r'git clone|wget |curl ', 30),
+    (r'easy_install|pip install', 15),
+    (r'tar x', 5),
+    (r'mkfs|dd if=/dev/zero', 10),
+    (r'namenode -format', 10),
+]
+
+JAVA_HOME = '/usr/lib/jvm/java-7-openjdk-amd64'
+
+# lines of compound commands that can't fail on their own
+SHELL_KEYWORDS = set(['then', 'else', 'fi', 'do', 'done', '{', '}', '(', ')',
+                      'esac'])
+
+
+def split_commands(command):
+    """
+    The (separator, command) pairs of a shell command line, where separator
+    is what joins the command to the one before it: '&&', '||', ';', a
+    newline or None for the first
+    """
+    parts = []
+    current = []
+    separator = None
+    quote = None
+    i = 0
+    while i < len(command):
+        c = command[i]
+        if c == '\\':
+            current.append(command[i:i + 2])
+            i += 2
+            continue
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif command[i:i + 2] in ('&&', '||') or c in ';\n':
+            token = command[i:i + 2] if c in '&|' else c
+            parts.append((separator, ''.join(current).strip()))
+            current = []
+            separator = token
+            i += len(token)
+            continue
+        current.append(c)
+        i += 1
+    parts.append((separator, ''.join(current).strip()))
+    return [(sep, cmd) for sep, cmd in parts if cmd and cmd not in SHELL_KEYWORDS]
+
+
+class FakeCluster(object):
+    """
+    A master plus workers sharing one network model. latency is the round
+    trip of every SSH operation in seconds, bandwidth is in bytes per second
+    and failure_rate is the probability that a command exits non-zero
+    """
+
+    def __init__(self, num_nodes, latency=0.05, bandwidth=50e6,
+                 failure_rate=0.0, time_scale=0.01, cores=8,
+                 memory_mb=30720, numa_nodes=1, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.bytes = 0
+        self.failures = 0
+        self.swallowed = 0
+        self.nodes = []
+        for i in range(num_nodes):
+            alias = 'master' if i == 0 else 'node%03d' % i
+            self.nodes.append(FakeNode(self, alias, cores, memory_mb, numa_nodes))
+        self.master = self.nodes[0]
+        self.master.cluster_groups = []
+        self.master.ec2 = FakeEC2()
+
+    def count(self, op, nbytes=0):
+        with self._lock:
+            self.counts[op] = self.counts.get(op, 0) + 1
+            self.bytes += nbytes
+
+    def add_bytes(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+
+    def should_fail(self):
+        with self._lock:
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+            return failed
+
+    def swallow(self):
+        with self._lock:
+            self.swallowed += 1
+
+    def wait(self, seconds):
+        time.sleep(seconds * self.time_scale)
+
+    def transfer(self, nbytes):
+        self.wait(self.latency + float(nbytes) / self.bandwidth)
+
+    def ssh_ops(self):
+        return sum(self.counts.values())
+
+
+class FakeEC2(object):
+    def has_permission(self, group, ip_protocol, from_port, to_port, cidr_ip):
+        return True
+
+
+class FakeInstance(object):
+    def __init__(self, placement, placement_group):
+        self.placement = placement
+        self.placement_group = placement_group
+
+
+class FakeNode(object):
+    def __init__(self, cluster, alias, cores, memory_mb, numa_nodes):
+        self.cluster = cluster
+        self.alias = alias
+        self.dns_name = '%s.fake.internal' % alias
+        self.private_ip_address = '10.0.%d.%d' % (len(cluster.nodes) // 256,
+                                                  len(cluster.nodes) % 256)
+        self.cores = cores
+        self.memory_mb = memory_mb
+        self.numa_nodes = numa_nodes
+        self.instance = FakeInstance('us-east-1a', None)
+        self.ssh = FakeSSH(self)
+
+    def __repr__(self):
+        return '<FakeNode %s>' % self.alias
+
+    def is_master(self):
+        return self is self.cluster.master
+
+    def apt_command(self, cmd):
+        dpkg_opts = "Dpkg::Options::='--force-confnew'"
+        cmd = "apt-get -o %s -y --force-yes %s" % (dpkg_opts, cmd)
+        self.ssh.execute("DEBIAN_FRONTEND='noninteractive' " + cmd)
+
+    def export_fs_to_nodes(self, nodes, export_paths):
+        for node in nodes:
+            self.ssh.execute('echo "%s %s" >> /etc/exports'
+                             % (' '.join(export_paths), node.alias))
+        self.ssh.execute('exportfs -fra')
+
+    def mount_nfs_shares(self, server_node, remote_paths):
+        for path in remote_paths:
+            self.ssh.execute('mount -t nfs %s:%s %s'
+                             % (server_node.alias, path, path))
+
+
+class FakeFile(StringIO):
+    def __init__(self, ssh, path, mode):
+        StringIO.__init__(self, ssh.files.get(path, '') if 'r' in mode else '')
+        self._ssh = ssh
+        self._path = path
+        self._mode = mode
+
+    def close(self):
+        contents = self.getvalue()
+        if 'r' not in self._mode:
+            self._ssh.files[self._path] = contents
+        self._ssh.cluster.add_bytes(len(contents))
+        self._ssh.cluster.transfer(len(contents))
+        StringIO.close(self)
+
+
+class FakeSSH(object):
+    """
+    Answers the commands whose output the plugins parse (hardware probe,
+    checkpoint markers, architecture) and returns no output for the rest
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.cluster = node.cluster
+        self.files = {}
+        self.dirs = set([JAVA_HOME])
+        self.markers = {}
+        self.running = set()
+        self._last_status = 0
+        self._responders = [
+            (r'^nproc;', self._probe),
+            (r'for f in (\S+)/\*\.done', self._load_markers),
+            (r'^echo (\w+) > (\S+)\.done$', self._mark_done),
+            (r"pgrep -f '([^']+)'", self._pgrep),
+            (r'dpkg --print-architecture', lambda m: ['amd64']),
+            (r'wget -q -O - (\S+)\.sha512$', self._published_sha),
+            (r'^dd if=/dev/zero', self._dd),
+            (r'checknative', lambda m: ['hadoop: true', 'snappy: true']),
+        ]
+
+    def _probe(self, match):
+        return ['%d' % self.node.cores, '%d' % (self.node.memory_mb * 1024),
+                '%d' % self.node.numa_nodes]
+
+    def _load_markers(self, match):
+        directory = match.group(1)
+        return ['%s %s' % (posixpath.basename(path), digest)
+                for path, digest in sorted(self.markers.items())
+                if posixpath.dirname(path) == directory]
+
+    def _mark_done(self, match):
+        self.markers[match.group(2)] = match.group(1)
+        return []
+
+    def _published_sha(self, match):
+        # sha512sum layout, as on the Apache mirrors
+        return ['%s  %s' % ('8b4f9a01' * 16, posixpath.basename(match.group(1)))]
+
+    def _dd(self, match):
+        return ['1073741824 bytes (1.1 GB) copied, 5.0 s, 215 MB/s',
+                '1073741824 bytes (1.1 GB) copied, 4.0 s, 268 MB/s']
+
+    def _pgrep(self, match):
+        pattern = match.group(1)
+        if any(re.search(pattern, name) for name in self.running):
+            return ['running']
+        return []
+
+    def _cost(self, command):
+        for pattern, seconds in COMMAND_COSTS:
+            if re.search(pattern, command):
+                return seconds
+        return 0
+
+    def _status(self, command):
+        # runs the command line's simple commands the way bash would, each
+        # failing at the cluster's failure rate
+        parts = split_commands(command)
+        errexit = any(cmd == 'set -e' for sep, cmd in parts)
+        status = 0
+        swallowed = False
+        for i, (sep, cmd) in enumerate(parts):
+            if (sep == '&&' and status) or (sep == '||' and not status):
+                continue
+            # a failure the next command just carries on from
+            swallowed = swallowed or (status and sep in (';', '\n'))
+            status = 1 if self.cluster.should_fail() else 0
+            following = parts[i + 1][0] if i + 1 < len(parts) else None
+            if status and errexit and following not in ('&&', '||'):
+                break
+        if swallowed:
+            self.cluster.swallow()
+        return status
+
+    def execute(self, command, silent=True, only_printable=False,
+                ignore_exit_status=False, log_output=True, detach=False,
+                source_profile=True, raise_on_failure=True):
+        self.cluster.count('execute', len(command))
+        self.cluster.transfer(len(command))
+        self.cluster.wait(self._cost(command))
+        self._last_status = self._status(command)
+        if self._last_status:
+            if not ignore_exit_status and raise_on_failure:
+                raise exception.RemoteCommandFailed(
+                    "simulated failure on %s" % self.node.alias,
+                    command, self._last_status, [])
+            return []
+        for pattern, respond in self._responders:
+            match = re.search(pattern, command, re.M)
+            if match:
+                return respond(match)
+        return []
+
+    def get_last_status(self):
+        return self._last_status
+
+    def remote_file(self, file, mode='w'):
+        self.cluster.count('remote_file')
+        return FakeFile(self, file, mode)
+
+    def put(self, localpaths, remotepath='.'):
+        paths = localpaths if isinstance(localpaths, list) else [localpaths]
+        nbytes = sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+        self.cluster.count('put', nbytes)
+        self.cluster.transfer(nbytes)
+        for path in paths:
+            self.files[posixpath.join(remotepath, os.path.basename(path))] = ''
+
+    def get(self, remotepaths, localpath=''):
+        self.cluster.count('get')
+        self.cluster.transfer(0)
+
+    def isfile(self, path):
+        self.cluster.count('stat')
+        self.cluster.transfer(0)
+        return path in self.files
+
+    def isdir(self, path):
+        self.cluster.count('stat')
+        self.cluster.transfer(0)
+        return path in self.dirs
+
+    def path_exists(self, path):
+        return self.isfile(path) or self.isdir(path)
@@ -6,7 +6,7 @@
 
 # Instructions:
 # open a fresh Ubuntu Vivid AMI
-# copy this file, sge.tar.gz and scimage_13.04.py to ~
+# copy this file, sge.tar.gz, scimage_13.04.py and the plugins directory to ~
 # edit /etc/apt/sources.list first to enable multiverse for Vivid
 # then run this file from ~
 # save this instance as a new starcluster compatible AMI
@@ -19,9 +19,10 @@ sudo ln -s /lib/systemd/system/nfs-kernel-server.service /lib/systemd/system/nfs
 sudo apt-get -y install python-scipy python-numpy
 mkdir starclustersetup
 cp scimage_13.04.py starclustersetup
+cp -r plugins starclustersetup
 cd starclustersetup
 chmod 764 scimage_13.04.py
-sudo python scimage_13.04.py
+sudo python scimage_13.04.py --with-stack
 sudo service apache2 stop
 sudo apt-get -y install nginx-core nginx
 cd ..
@@ -38,6 +39,6 @@ tar -xvsf sge.tar.gz
 sudo cp -r sge6-fresh /opt
 cd
 rm -r sge starclustersetup
-rm sge.tar.gz scimage_13.04.py
+rm -r sge.tar.gz scimage_13.04.py plugins
 rm doall.sh
 
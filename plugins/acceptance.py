@@ -0,0 +1,222 @@
+from starcluster import clustersetup
+from starcluster.logger import log
+
+import json
+import posixpath
+
+import diskprep
+import nodeprobe
+import clusterutils
+import tracing
+
+# An opt-in acceptance stage: listed after the install plugins, it runs the
+# same micro-benchmarks on every node (dgemm through the BLAS numpy is linked
+# against, a 1D complex FFT through FFTW, sequential dd on each data volume
+# and a small local Spark job) and writes the results to a JSON file on the
+# master. Nodes that fall far short of the cluster median on any metric are
+# flagged, since a wrong BLAS, a slow disk or a bad instance otherwise only
+# shows up later as slow jobs. A node where the Spark job fails outright is
+# flagged on it as well
+
+BENCH_SCRIPT = '/tmp/starcluster-acceptance.py'
+
+# runs on the node with its own python; prints one line of JSON
+bench_script = r"""
+import ctypes
+import json
+import math
+import time
+
+import numpy
+
+
+def best(fn, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def dgemm(n=2048):
+    a = numpy.random.rand(n, n)
+    b = numpy.random.rand(n, n)
+    numpy.dot(a, b)
+    return 2.0 * n ** 3 / best(lambda: numpy.dot(a, b), 3) / 1e9
+
+
+def fft(n=2 ** 20):
+    for name in ('libfftw3.so', 'libfftw3.so.3'):
+        try:
+            fftw = ctypes.CDLL(name)
+            break
+        except OSError:
+            pass
+    else:
+        return None
+    fftw.fftw_malloc.restype = ctypes.c_void_p
+    fftw.fftw_malloc.argtypes = [ctypes.c_size_t]
+    fftw.fftw_plan_dft_1d.restype = ctypes.c_void_p
+    fftw.fftw_plan_dft_1d.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                      ctypes.c_void_p, ctypes.c_int, ctypes.c_uint]
+    fftw.fftw_execute.argtypes = [ctypes.c_void_p]
+    fftw.fftw_destroy_plan.argtypes = [ctypes.c_void_p]
+    fftw.fftw_free.argtypes = [ctypes.c_void_p]
+    data = fftw.fftw_malloc(16 * n)
+    out = fftw.fftw_malloc(16 * n)
+    ctypes.memset(data, 0, 16 * n)
+    # FFTW_FORWARD, FFTW_ESTIMATE
+    plan = fftw.fftw_plan_dft_1d(n, data, out, -1, 1 << 6)
+    seconds = best(lambda: fftw.fftw_execute(plan), 10)
+    fftw.fftw_destroy_plan(plan)
+    fftw.fftw_free(data)
+    fftw.fftw_free(out)
+    # FFTW's own convention of 5 n log2(n) flops per complex transform
+    return 5.0 * n * math.log(n, 2) / seconds / 1e9
+
+
+print(json.dumps({'dgemm_gflops': dgemm(), 'fft_gflops': fft()}))
+"""
+
+spark_job_templ = """\
+test -x {spark_home}/bin/spark-submit || exit 0
+start=$(date +%s.%N)
+{spark_home}/bin/spark-submit --master 'local[{cores}]' \
+  {spark_home}/examples/src/main/python/pi.py 20 > /dev/null 2>&1 || {{
+  echo failed
+  exit 0
+}}
+awk -v t0=$start -v t1=$(date +%s.%N) 'BEGIN {{printf "%.2f\\n", t1 - t0}}'
+"""
+
+# metrics where less is better; for the rest more is better
+LOWER_IS_BETTER = ['spark_pi_seconds']
+# a node's results list the metrics whose benchmark failed under this key
+FAILED = 'failed'
+
+
+class ClusterAcceptance(clustersetup.DefaultClusterSetup):
+    """
+    Benchmarks every node and writes the results to results_path on the
+    master; a node is flagged on a metric when it is worse than the cluster
+    median by more than a factor of threshold (0.7 flags a node at under 70%
+    of the median throughput, or over 1/0.7 times the median job time).
+    trace_file, if given, is where the timeline is written
+    """
+
+    def __init__(self, spark_home='/opt/Spark', threshold=0.7,
+                 results_path='/home/cluster-acceptance.json', trace_file=None):
+        super(ClusterAcceptance, self).__init__()
+        self.spark_home = spark_home
+        self.threshold = float(threshold)
+        self.results_path = results_path
+        if trace_file:
+            tracing.enable(trace_file)
+
+    @property
+    def pool(self):
+        return tracing.TracedPool(super(ClusterAcceptance, self).pool)
+
+    def _compute(self, node):
+        fout = node.ssh.remote_file(BENCH_SCRIPT, 'w')
+        fout.write(bench_script)
+        fout.close()
+        out = node.ssh.execute('python %s' % BENCH_SCRIPT)
+        node.ssh.execute('rm -f %s' % BENCH_SCRIPT)
+        return json.loads(out[-1])
+
+    def _disks(self, node, volumes):
+        if not volumes:
+            return {}
+        # the data volumes are used striped, so their bandwidth adds up
+        rates = [diskprep.throughput(node, volume) for volume in volumes]
+        return {'disk_write_mbps': sum(w for w, r in rates),
+                'disk_read_mbps': sum(r for w, r in rates)}
+
+    def _spark_job(self, node, resources):
+        out = node.ssh.execute(spark_job_templ.format(spark_home=self.spark_home,
+                                                      cores=resources.usable_cores()))
+        if out and out[-1] == 'failed':
+            log.warn("...%s: the Spark job failed" % node.alias)
+            return {'spark_pi_seconds': None, FAILED: ['spark_pi_seconds']}
+        return {'spark_pi_seconds': float(out[-1]) if out else None}
+
+    def _bench_node(self, node, exclude):
+        resources = nodeprobe.probe(node, exclude)
+        results = self._compute(node)
+        results.update(self._disks(node, resources.data_volumes))
+        results.update(self._spark_job(node, resources))
+        log.info("...%s: %s" % (node.alias, ', '.join(
+            '%s %.1f' % (k, v) for k, v in sorted(results.items())
+            if isinstance(v, (int, float)))))
+        return results
+
+    def _median(self, values):
+        values = sorted(values)
+        mid = len(values) // 2
+        if len(values) % 2:
+            return values[mid]
+        return (values[mid - 1] + values[mid]) / 2.0
+
+    def _report(self, by_node):
+        """Medians per metric and the metrics each node fails or falls short on"""
+        medians = {}
+        metrics = set(k for results in by_node.values() for k in results)
+        for metric in metrics - set([FAILED]):
+            values = [r[metric] for r in by_node.values() if r.get(metric) is not None]
+            if values:
+                medians[metric] = self._median(values)
+        flagged = {}
+        for alias, results in sorted(by_node.items()):
+            if results.get(FAILED):
+                flagged[alias] = list(results[FAILED])
+            for metric, median in sorted(medians.items()):
+                value = results.get(metric)
+                if value is None or median <= 0:
+                    continue
+                if metric in LOWER_IS_BETTER:
+                    bad = value * self.threshold > median
+                else:
+                    bad = value < median * self.threshold
+                if bad:
+                    flagged.setdefault(alias, []).append(metric)
+                    log.warn("%s: %s is %.1f against a cluster median of %.1f"
+                             % (alias, metric, value, median))
+        return {'nodes': by_node, 'medians': medians, 'flagged': flagged}
+
+    def _write(self, master, report):
+        master.ssh.execute('mkdir -p %s' % posixpath.dirname(self.results_path))
+        fout = master.ssh.remote_file(self.results_path, 'w')
+        fout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+        fout.close()
+        log.info("Acceptance results are in %s on %s (%d of %d nodes flagged)"
+                 % (self.results_path, master.alias, len(report['flagged']),
+                    len(report['nodes'])))
+
+    def _read(self, master):
+        out = master.ssh.execute('cat %s 2>/dev/null || true' % self.results_path)
+        try:
+            return json.loads('\n'.join(out))['nodes']
+        except (ValueError, KeyError):
+            return {}
+
+    @tracing.traced_hook
+    def run(self, nodes, master, user, user_shell, volumes):
+        log.info("Benchmarking %d nodes" % len(nodes))
+        by_node = clusterutils.map_nodes(self.pool, nodes, self._bench_node,
+                                         nodeprobe.volume_mounts(volumes))
+        self._write(master, self._report(by_node))
+
+    @tracing.traced_hook
+    def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Benchmarking %s" % node.alias)
+        by_node = self._read(master)
+        by_node[node.alias] = self._bench_node(node, nodeprobe.volume_mounts(volumes))
+        self._write(master, self._report(by_node))
+
+    @tracing.traced_hook
+    def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        by_node = self._read(master)
+        if by_node.pop(node.alias, None) is not None:
+            self._write(master, self._report(by_node))
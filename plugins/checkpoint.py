@@ -0,0 +1,45 @@
+import hashlib
+import posixpath
+
+# Per-node completion markers for setup steps. Each marker holds a digest of
+# the step's inputs, so a rerun skips steps that already finished with the
+# same inputs and redoes the ones that failed or whose inputs changed
+
+CHECKPOINT_ROOT = '/var/lib/starcluster-setup'
+
+
+def digest(*inputs):
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+
+class Checkpoints(object):
+    def __init__(self, node, plugin):
+        self.node = node
+        self.directory = posixpath.join(CHECKPOINT_ROOT, plugin)
+        self._markers = None
+
+    def _marker(self, step):
+        return posixpath.join(self.directory, step + '.done')
+
+    def load(self):
+        """Reads every marker for this plugin with a single command"""
+        out = self.node.ssh.execute(
+            'mkdir -p {0}; for f in {0}/*.done; do '
+            'test -f $f && echo `basename $f .done` `cat $f`; done; true'.format(
+                self.directory))
+        self._markers = {}
+        for line in out:
+            parts = line.split()
+            if len(parts) == 2:
+                self._markers[parts[0]] = parts[1]
+        return self._markers
+
+    def is_done(self, step, step_digest):
+        if self._markers is None:
+            self.load()
+        return self._markers.get(step) == step_digest
+
+    def mark_done(self, step, step_digest):
+        self.node.ssh.execute('echo %s > %s' % (step_digest, self._marker(step)))
+        if self._markers is not None:
+            self._markers[step] = step_digest
@@ -0,0 +1,294 @@
+from starcluster.logger import log
+
+import functools
+import pipes
+import posixpath
+import re
+
+# Helpers shared by the setup plugins in this directory
+
+# Build artifacts that only need to be produced once per cluster are staged
+# on the master under ARTIFACT_ROOT and served to the other nodes over HTTP,
+# so workers can pull them in parallel instead of rebuilding them
+ARTIFACT_ROOT = '/opt/starcluster-artifacts'
+ARTIFACT_PORT = 8765
+ARTIFACT_PIDFILE = '/var/run/starcluster-artifacts.pid'
+
+
+def as_bool(value):
+    # StarCluster hands plugin settings over as strings
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def artifact_path(name):
+    return posixpath.join(ARTIFACT_ROOT, name)
+
+
+def artifact_url(master, name):
+    return 'http://%s:%d/%s' % (master.alias, ARTIFACT_PORT, name)
+
+
+def serve_artifacts(master):
+    """
+    Starts a static file server for ARTIFACT_ROOT on the master unless one
+    is already running
+    """
+    log.info("Serving build artifacts from %s:%s" % (master.alias, ARTIFACT_ROOT))
+    master.ssh.execute('mkdir -p %s' % ARTIFACT_ROOT)
+    master.ssh.execute(
+        '(test -f {pid} && kill -0 `cat {pid}` 2>/dev/null) || '
+        '(cd {root} && nohup python -m SimpleHTTPServer {port} '
+        '< /dev/null > /dev/null 2>&1 & echo $! > {pid})'.format(
+            pid=ARTIFACT_PIDFILE, root=ARTIFACT_ROOT, port=ARTIFACT_PORT))
+
+
+def fetch_artifact(node, master, name, dest):
+    """
+    Copies the artifact called name to dest on node: straight from disk on
+    the master, over HTTP from the master everywhere else
+    """
+    if node.alias == master.alias:
+        node.ssh.execute('cp %s %s' % (artifact_path(name), dest))
+    else:
+        node.ssh.execute('wget -q -O %s %s' % (dest, artifact_url(master, name)))
+
+
+# Locally built .deb files are published as a flat apt repository in the
+# APT_REPO subdirectory of the artifact root
+APT_REPO = 'apt'
+APT_SOURCES_LIST = '/etc/apt/sources.list.d/starcluster-local.list'
+
+deb_control_templ = """\
+Package: %(package)s
+Version: %(version)s
+Architecture: %(arch)s
+Maintainer: StarCluster setup plugins <root@localhost>
+Depends: %(depends)s
+Description: %(description)s
+"""
+
+
+def apt_repo_path(name=''):
+    return posixpath.join(ARTIFACT_ROOT, APT_REPO, name)
+
+
+def build_deb(master, staging, package, version, depends, description,
+              postinst=None):
+    """
+    Packages the tree under staging (laid out relative to /) on the master
+    into the local apt repository and returns the path of the .deb
+    """
+    arch = master.ssh.execute('dpkg --print-architecture')[0].strip()
+    debian = posixpath.join(staging, 'DEBIAN')
+    master.ssh.execute('mkdir -p %s' % debian)
+    fout = master.ssh.remote_file(posixpath.join(debian, 'control'), 'w')
+    fout.write(deb_control_templ % {'package': package, 'version': version,
+                                    'arch': arch, 'depends': depends,
+                                    'description': description})
+    fout.close()
+    if postinst:
+        fname = posixpath.join(debian, 'postinst')
+        fout = master.ssh.remote_file(fname, 'w')
+        fout.write('#!/bin/sh\nset -e\n' + postinst)
+        fout.close()
+        master.ssh.execute('chmod 755 %s' % fname)
+    deb = apt_repo_path('%s_%s_%s.deb' % (package, version, arch))
+    master.ssh.execute('mkdir -p %s && dpkg-deb --build %s %s' %
+                       (apt_repo_path(), staging, deb))
+    return deb
+
+
+def index_apt_repo(master):
+    master.ssh.execute('cd %s && dpkg-scanpackages . /dev/null 2>/dev/null '
+                       '| gzip -9c > Packages.gz' % apt_repo_path())
+
+
+def add_apt_repo(node, master):
+    """
+    Points apt on node at the master's local repository and refreshes only
+    that source
+    """
+    fout = node.ssh.remote_file(APT_SOURCES_LIST, 'w')
+    fout.write('deb [trusted=yes] %s ./\n' % artifact_url(master, APT_REPO))
+    fout.close()
+    node.ssh.execute('apt-get update -o Dir::Etc::sourcelist=%s '
+                     '-o Dir::Etc::sourceparts=- '
+                     '-o APT::Get::List-Cleanup=0' % APT_SOURCES_LIST)
+
+
+# Maven builds on the cluster share one local repository, MAVEN_REPO on the
+# master (NFS-mounted where other nodes build), so dependencies are only
+# downloaded by the first build. Once a build has succeeded against it,
+# later runs of that build go offline; an image baked with the stack ships
+# the repository already seeded
+MAVEN_REPO = '/opt/starcluster-maven'
+
+
+def _maven_marker(key):
+    return posixpath.join(MAVEN_REPO, '.seeded-%s' % key)
+
+
+def maven_args(node, key, threads):
+    """Maven arguments for the build called key on node"""
+    out = node.ssh.execute('mkdir -p %s; test -f %s && echo seeded || true'
+                           % (MAVEN_REPO, _maven_marker(key)))
+    args = '-Dmaven.repo.local=%s -T %d' % (MAVEN_REPO, threads)
+    if 'seeded' in ''.join(out):
+        args += ' -o'
+    return args
+
+
+def mark_maven_seeded(node, key):
+    node.ssh.execute('touch %s' % _maven_marker(key))
+
+
+# A caching apt proxy on the master means each .deb crosses the WAN once per
+# cluster; the master's own artifact server is always reached directly
+APT_PROXY_PORT = 3142
+APT_PROXY_CONF = '/etc/apt/apt.conf.d/01starcluster-proxy'
+
+
+def serve_apt_proxy(master):
+    log.info("Running apt-cacher-ng on %s" % master.alias)
+    master.apt_command('install apt-cacher-ng')
+    master.ssh.execute('service apt-cacher-ng status > /dev/null || '
+                       'service apt-cacher-ng start')
+
+
+def use_apt_proxy(node, master):
+    fout = node.ssh.remote_file(APT_PROXY_CONF, 'w')
+    fout.write('Acquire::http::Proxy "http://%s:%d";\n' %
+               (master.alias, APT_PROXY_PORT))
+    fout.write('Acquire::http::Proxy::%s "DIRECT";\n' % master.alias)
+    fout.close()
+
+
+def add_line(node, path, line):
+    node.ssh.execute('grep -qxF {0} {1} || echo {0} >> {1}'.format(
+        pipes.quote(line), pipes.quote(path)))
+
+
+def remove_line(node, path, line):
+    # escapes what is special to sed's basic regexes, '/' included
+    pattern = re.sub(r'([.\[\]*^$\\/])', r'\\\1', line)
+    node.ssh.execute("test ! -f {1} || sed -i '/^{0}$/d' {1}".format(
+        pattern, pipes.quote(path)))
+
+
+def process_running(node, pattern):
+    # pattern is a regex matched against full command lines; write it so it
+    # cannot match itself, e.g. 'deploy[.]master[.]Master'
+    out = node.ssh.execute("pgrep -f '%s' > /dev/null && echo running || true"
+                           % pattern)
+    return 'running' in ''.join(out)
+
+
+def share_dir(pool, master, nodes, path):
+    """
+    Exports path from the master over NFS and mounts it on the other nodes;
+    StarCluster already shares /home
+    """
+    master.ssh.execute('mkdir -p %s' % path)
+    workers = [n for n in nodes if n.alias != master.alias]
+    if posixpath.normpath(path).startswith('/home/') or not workers:
+        return
+    log.info("Sharing %s from %s" % (path, master.alias))
+    master.export_fs_to_nodes(workers, [path])
+    for node in workers:
+        pool.simple_job(node.mount_nfs_shares, (master, [path]), jobid=node.alias)
+    pool.wait(numtasks=len(workers))
+
+
+def map_nodes(pool, nodes, func, *args):
+    """
+    Runs func(node, *args) on every node in parallel and returns the results
+    in a dict by alias. The jobs are named after func, so traces tell the
+    callers apart
+    """
+    results = {}
+
+    @functools.wraps(func)
+    def _job(node):
+        results[node.alias] = func(node, *args)
+
+    for node in nodes:
+        pool.simple_job(_job, (node,), jobid=node.alias)
+    pool.wait(numtasks=len(nodes))
+    return results
+
+
+# Downloads are cached on the master under their content hash, so a file is
+# fetched once however many versions, profiles or reruns point at it
+DOWNLOAD_CACHE = posixpath.join(ARTIFACT_ROOT, 'by-hash')
+
+download_templ = """\
+set -e
+mkdir -p {cache}
+if [ ! -f {cached} ]; then
+  wget -q -O {cached}.partial {url}
+  echo "{digest}  {cached}.partial" | {algorithm}sum -c --quiet - || {{
+    rm -f {cached}.partial
+    echo "checksum mismatch for {url}" >&2
+    exit 1
+  }}
+  mv {cached}.partial {cached}
+fi
+ln -sf {cached} {artifact}
+"""
+
+
+# the checksum files the Apache mirrors publish next to a release, newest
+# convention first, with the algorithm each holds; the legacy .sha is SHA512
+CHECKSUM_SUFFIXES = [('sha512', 'sha512'), ('sha256', 'sha256'), ('sha', 'sha512')]
+HEX_DIGITS = {'md5': 32, 'sha1': 40, 'sha256': 64, 'sha512': 128}
+
+
+def _published_digest(text, algorithm):
+    # either sha512sum layout ('9a01...  name') or gpg --print-md layout
+    # ('name: 9A01 8B4F ...', wrapped over several lines)
+    words = text.split()
+    candidates = words[:1]
+    if ':' in text:
+        candidates.append(re.sub(r'\s+', '', text.split(':', 1)[1]))
+    for candidate in candidates:
+        if re.match(r'^[0-9a-fA-F]{%d}$' % HEX_DIGITS[algorithm], candidate):
+            return candidate.lower()
+    return None
+
+
+def published_checksum(master, url):
+    """
+    Returns (algorithm, hexdigest) from the first checksum file published
+    next to url, trying url.sha512, url.sha256 and then the legacy url.sha
+    """
+    for suffix, algorithm in CHECKSUM_SUFFIXES:
+        text = '\n'.join(master.ssh.execute('wget -q -O - %s.%s' % (url, suffix),
+                                            ignore_exit_status=True))
+        hexdigest = _published_digest(text, algorithm)
+        if hexdigest:
+            return algorithm, hexdigest
+    raise Exception("no checksum published at %s.{%s}"
+                    % (url, ','.join(suffix for suffix, algorithm in CHECKSUM_SUFFIXES)))
+
+
+def parse_checksum(value):
+    """Parses an 'algorithm:hexdigest' setting, e.g. 'sha256:9f86d08...'"""
+    algorithm, _, hexdigest = value.partition(':')
+    if algorithm not in ('md5', 'sha1', 'sha256', 'sha512') or not hexdigest:
+        raise ValueError("checksum must look like sha512:<hex>, got %r" % value)
+    return algorithm, hexdigest.lower()
+
+
+def cached_download(master, url, name, checksum):
+    """
+    Makes the artifact called name on the master a copy of url verified
+    against checksum, an (algorithm, hexdigest) pair, downloading it only if
+    nothing with that hash is cached yet
+    """
+    algorithm, hexdigest = checksum
+    master.ssh.execute(download_templ.format(
+        cache=DOWNLOAD_CACHE, url=url, digest=hexdigest, algorithm=algorithm,
+        cached=posixpath.join(DOWNLOAD_CACHE, '%s-%s' % (algorithm, hexdigest)),
+        artifact=artifact_path(name)))
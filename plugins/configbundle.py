@@ -0,0 +1,74 @@
+import pipes
+import posixpath
+import tarfile
+import time
+import uuid
+
+from StringIO import StringIO
+
+# Configuration for a node is rendered on the controller into a ConfigBundle,
+# shipped as one tarball and installed by one remote command: every file is
+# first staged next to its destination and then renamed into place, so a
+# node never sees a half-written config file
+
+
+class ConfigBundle(object):
+    def __init__(self):
+        self._files = []
+        self._edits = []
+        self._commands = []
+
+    def add_file(self, path, contents, mode=0644):
+        self._files.append((path, contents, mode))
+
+    def append_line(self, path, line):
+        """Appends line to the existing file at path unless already there"""
+        self._edits.append('grep -qxF {0} {1} || echo {0} >> {1}'.format(
+            pipes.quote(line), pipes.quote(path)))
+
+    def prepend_line(self, path, line):
+        """Inserts line at the top of the existing file at path unless
+        already there"""
+        self._edits.append("grep -qxF {0} {1} || sed -i '1i\\{2}' {1}".format(
+            pipes.quote(line), pipes.quote(path), line.replace("'", "'\\''")))
+
+    def add_command(self, command):
+        """Runs command on the node once the files are in place"""
+        self._commands.append(command)
+
+    def _archive(self):
+        data = StringIO()
+        tar = tarfile.open(fileobj=data, mode='w:gz')
+        now = time.time()
+        for path, contents, mode in self._files:
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(contents)
+            info.mode = mode
+            info.mtime = now
+            tar.addfile(info, StringIO(contents))
+        tar.close()
+        return data.getvalue()
+
+    def _install_script(self, archive):
+        script = ['set -e',
+                  'staging=`mktemp -d /tmp/starcluster-config.XXXXXX`',
+                  'tar xzf %s -C $staging --no-same-owner' % archive]
+        for path, contents, mode in self._files:
+            script.append('mkdir -p %s' % pipes.quote(posixpath.dirname(path)))
+            script.append('cp -p $staging%s %s' % (pipes.quote(path),
+                                                   pipes.quote(path + '.new')))
+        for path, contents, mode in self._files:
+            script.append('mv -f %s %s' % (pipes.quote(path + '.new'),
+                                           pipes.quote(path)))
+        script.extend(self._edits)
+        script.extend(self._commands)
+        script.append('rm -rf $staging %s' % archive)
+        return '\n'.join(script)
+
+    def push(self, node):
+        """Installs the bundle on node with one transfer and one command"""
+        archive = '/tmp/starcluster-config-%s.tar.gz' % uuid.uuid4().hex
+        fout = node.ssh.remote_file(archive, 'w')
+        fout.write(self._archive())
+        fout.close()
+        node.ssh.execute(self._install_script(archive))
@@ -0,0 +1,155 @@
+import pipes
+
+# Renders the start scripts the plugins leave on the master. Instead of the
+# stock sbin/*-daemons.sh and start-slaves.sh, which SSH to one worker after
+# another, a launcher starts the daemons of a stage on all of its hosts at
+# once and then polls each daemon's port from the master until it accepts
+# connections. A stage only starts once every daemon of the one before it is
+# ready, so workers never race the master they register with. Each daemon's
+# time to ready is printed as it comes up, followed by the total, and the
+# script exits non-zero if anything failed to start or to open its port in
+# time. The matching stop script runs the stop commands of a stage on all
+# of its hosts at once as well, so every host stops its daemons by its own
+# configuration
+
+DEFAULT_TIMEOUT = 300
+# concurrent SSH sessions from the master
+DEFAULT_PARALLEL = 64
+
+launcher_templ = """\
+#!/usr/bin/env bash
+# Starts the {title} daemons; generated by StarCluster
+TIMEOUT={timeout}
+PARALLEL={parallel}
+SSH="ssh -o BatchMode=yes -o StrictHostKeyChecking=no"
+T0=$(date +%s.%N)
+FAILED=$(mktemp)
+
+elapsed() {{
+  awk -v t0=$1 -v t1=$(date +%s.%N) 'BEGIN {{printf "%.1f", t1 - t0}}'
+}}
+
+{throttle}
+launch() {{
+  local host=$1 name=$2 port=$3 command=$4 t0=$(date +%s.%N)
+  if ! $SSH $host "$command" > /dev/null 2>&1; then
+    echo "$host $name: failed to start" | tee -a $FAILED
+    return
+  fi
+  until timeout 1 bash -c "echo > /dev/tcp/$host/$port" 2> /dev/null; do
+    if [ $(elapsed $t0 | cut -d. -f1) -ge $TIMEOUT ]; then
+      echo "$host $name: port $port not open after ${{TIMEOUT}}s" | tee -a $FAILED
+      return
+    fi
+    sleep 0.2
+  done
+  printf "%-24s %-16s ready in %6ss\\n" $host $name $(elapsed $t0)
+}}
+
+finish() {{
+  if [ -s $FAILED ]; then
+    echo "$(wc -l < $FAILED) {title} daemon(s) failed after $(elapsed $T0)s"
+    rm -f $FAILED
+    exit 1
+  fi
+}}
+{stages}
+rm -f $FAILED
+echo "{title} ready in $(elapsed $T0)s"
+"""
+
+stage_templ = """
+for host in {hosts}; do
+{launches}done
+wait
+finish
+"""
+
+throttle_func = """\
+throttle() {
+  while [ $(jobs -r | wc -l) -ge $PARALLEL ]; do
+    sleep 0.1
+  done
+}
+"""
+
+stopper_templ = """\
+#!/usr/bin/env bash
+# Stops the {title} daemons; generated by StarCluster
+PARALLEL={parallel}
+SSH="ssh -o BatchMode=yes -o StrictHostKeyChecking=no"
+FAILED=$(mktemp)
+
+{throttle}
+stop() {{
+  if ! $SSH $1 "$2" > /dev/null 2>&1; then
+    echo "$1: failed to stop $3" | tee -a $FAILED
+  fi
+}}
+{stages}
+if [ -s $FAILED ]; then
+  rm -f $FAILED
+  exit 1
+fi
+rm -f $FAILED
+echo "{title} stopped"
+"""
+
+stop_stage_templ = """
+for host in {hosts}; do
+{stops}done
+wait
+"""
+
+
+class Daemon(object):
+    """
+    A daemon that command starts on a host and that is ready once it
+    accepts connections on port
+    """
+
+    def __init__(self, name, port, command):
+        self.name = name
+        self.port = port
+        self.command = command
+
+
+def _hosts(hosts):
+    # a path is a hosts file such as conf/slaves, read when the script runs
+    # so nodes added later are picked up
+    if isinstance(hosts, basestring):
+        return '$(cat %s)' % pipes.quote(hosts)
+    return ' '.join(pipes.quote(h) for h in hosts)
+
+
+def script(title, stages, timeout=DEFAULT_TIMEOUT, parallel=DEFAULT_PARALLEL):
+    """
+    The launcher for stages, a list of (hosts, daemons) pairs where hosts is
+    a list of host names or the path of a file listing them, one per line
+    """
+    rendered = []
+    for hosts, daemons in stages:
+        launches = ''.join('  throttle\n  launch $host %s %d %s &\n'
+                           % (pipes.quote(d.name), d.port, pipes.quote(d.command))
+                           for d in daemons)
+        rendered.append(stage_templ.format(hosts=_hosts(hosts), launches=launches))
+    return launcher_templ.format(title=title, timeout=int(timeout),
+                                 parallel=int(parallel), throttle=throttle_func,
+                                 stages=''.join(rendered))
+
+
+def stop_script(title, stages, parallel=DEFAULT_PARALLEL):
+    """
+    The stop script for stages, a list of (hosts, daemons) pairs like
+    script's but with each daemon's command stopping it (its port is not
+    used); a stage's daemons
+    are stopped on all of its hosts at once, and only after the stage before
+    """
+    rendered = []
+    for hosts, daemons in stages:
+        stops = ''.join('  throttle\n  stop $host %s %s &\n'
+                        % (pipes.quote(d.command), pipes.quote(d.name))
+                        for d in daemons)
+        rendered.append(stop_stage_templ.format(hosts=_hosts(hosts), stops=stops))
+    return stopper_templ.format(title=title, parallel=int(parallel),
+                                throttle=throttle_func, stages=''.join(rendered))
@@ -0,0 +1,123 @@
+from starcluster.logger import log
+
+import re
+
+import clusterutils
+import nodeprobe
+
+# Prepares a node's instance-store disks as data volumes. EC2 only mounts
+# the first ephemeral disk (at /mnt); every other blank disk is formatted
+# and mounted at /mnt1, /mnt2, ... either one per disk ('jbod', which
+# Hadoop stripes over itself) or combined into one RAID0 array ('raid0').
+# Volumes are labelled scdata<n> and listed in fstab by label with nofail,
+# so they come back after a reboot and rerunning only picks up disks that
+# are still blank. A disk is blank when it has no partitions, no mounted
+# filesystem and no signature of any kind (filesystem, swap, RAID member).
+# Newly formatted volumes get a quick dd throughput check; the volumes that
+# were already there are only measured when asked to
+
+LAYOUTS = ('jbod', 'raid0', 'none')
+LABEL_PREFIX = 'scdata'
+MOUNT_OPTIONS = 'defaults,noatime,nodiratime,nofail'
+# mdadm's default chunk, in filesystem blocks of 4k
+RAID_CHUNK_BLOCKS = 128
+
+prepare_templ = """\
+set -e
+mount -a 2>/dev/null || true
+blank=""
+for name in $(lsblk -dn -o NAME,TYPE | awk '$2 == "disk" {{print $1}}'); do
+  dev=/dev/$name
+  [ $(lsblk -n -o NAME $dev | wc -l) -eq 1 ] || continue
+  [ -z "$(lsblk -n -o MOUNTPOINT $dev | tr -d ' ')" ] || continue
+  blkid -p $dev > /dev/null 2>&1 && continue
+  blank="$blank $dev"
+done
+[ -n "$blank" ] || exit 0
+n=$(( $(blkid -o value -s LABEL | sed -n 's/^{label}//p' | sort -n | tail -1) + 1 ))
+count=$(echo $blank | wc -w)
+extended=lazy_itable_init=1,lazy_journal_init=1
+if [ {layout} = raid0 ] && [ $count -gt 1 ]; then
+  mdadm --create /dev/md/{label}$n --run --level=0 --raid-devices=$count $blank
+  mdadm --detail --scan | grep -F {label}$n >> /etc/mdadm/mdadm.conf
+  blank=/dev/md/{label}$n
+  extended=$extended,stride={chunk},stripe_width=$(( {chunk} * count ))
+fi
+for dev in $blank; do
+  mkfs.ext4 -q -F -m 0 -T largefile -E $extended -L {label}$n $dev
+  mkdir -p /mnt$n
+  grep -q "^LABEL={label}$n " /etc/fstab ||
+    echo "LABEL={label}$n /mnt$n ext4 {options} 0 2" >> /etc/fstab
+  mount /mnt$n
+  echo /mnt$n
+  n=$((n + 1))
+done
+"""
+
+# sequential write then read of 1GB, bypassing the page cache
+throughput_templ = """\
+set -e
+dd if=/dev/zero of={path} bs=1M count={mb} conv=fdatasync 2>&1 | tail -1
+echo 3 > /proc/sys/vm/drop_caches
+dd if={path} of=/dev/null bs=1M iflag=direct 2>&1 | tail -1
+rm -f {path}
+"""
+
+DD_RE = re.compile(r'^(\d+) bytes .* copied, ([\d.]+) s')
+
+
+def prepare(node, layout='jbod'):
+    """Formats and mounts node's blank disks, returns the new mount points"""
+    if layout not in LAYOUTS:
+        raise ValueError("disk layout must be one of %s, got %r"
+                         % (', '.join(LAYOUTS), layout))
+    if layout == 'none':
+        return []
+    if layout == 'raid0':
+        node.apt_command('--no-install-recommends install mdadm')
+    out = node.ssh.execute(prepare_templ.format(layout=layout, label=LABEL_PREFIX,
+                                                chunk=RAID_CHUNK_BLOCKS,
+                                                options=MOUNT_OPTIONS))
+    mounts = [line.strip() for line in out if line.startswith('/mnt')]
+    if mounts:
+        log.info("...%s: mounted %s" % (node.alias, ', '.join(mounts)))
+    return mounts
+
+
+def _rate(line):
+    # MB/s from dd's summary line, whatever unit dd chose to print it in
+    match = DD_RE.match(line.strip())
+    if not match or float(match.group(2)) == 0:
+        return None
+    return int(match.group(1)) / float(match.group(2)) / 1e6
+
+
+def throughput(node, volume, mb=1024):
+    """Sequential (write, read) MB/s of the data volume mounted at volume"""
+    path = '%s/.starcluster-ddtest' % volume.rstrip('/')
+    out = node.ssh.execute(throughput_templ.format(path=path, mb=mb))
+    rates = [_rate(line) for line in out if DD_RE.match(line.strip())]
+    if len(rates) != 2:
+        raise Exception("can't parse dd output on %s: %s" % (node.alias, out))
+    return tuple(rates)
+
+
+def prepare_all(pool, nodes, layout='jbod', exclude=(), benchmark=False):
+    """
+    Prepares every node's disks and then probes the node, in one parallel job
+    per node, and returns a dict of NodeResources by alias. The volumes
+    formatted just now are measured, and with benchmark every data volume
+    """
+    return clusterutils.map_nodes(pool, nodes, _prepare_node, layout, exclude,
+                                  benchmark)
+
+
+def _prepare_node(node, layout, exclude, benchmark):
+    mounts = prepare(node, layout)
+    resources = nodeprobe.probe(node, exclude)
+    volumes = resources.data_volumes if benchmark else mounts
+    rates = dict((v, throughput(node, v)) for v in volumes)
+    if rates:
+        log.info("...%s: %s" % (node.alias, ', '.join(
+            '%s %d/%d MB/s write/read' % (v, w, r) for v, (w, r) in sorted(rates.items()))))
+    return resources
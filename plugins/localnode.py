@@ -0,0 +1,110 @@
+from starcluster import exception
+
+import os
+import re
+import shutil
+import socket
+import subprocess
+
+# Lets the plugins' install code run on the machine it is imported on, e.g.
+# inside the image chroot from scimage_13.04.py, by standing in for a
+# StarCluster Node and its SSHClient. Relative remote paths are taken
+# relative to the home directory, as they are over SSH. Given a
+# package_lock, every apt-get or dpkg command holds it, and given a
+# pip_lock, every pip, easy_install or setup.py install does, so the install
+# code can run alongside other steps that install packages under the same
+# locks. Commands are run by run(command, cwd, name), which returns the exit
+# status and the output lines; scimage_13.04.py hands in one that logs and
+# traces them like its own commands
+
+
+PACKAGE_COMMAND_RE = re.compile(r'(^|[\s;&|(])(apt-get|dpkg)\s')
+PIP_COMMAND_RE = re.compile(r'(^|[\s;&|(/])(pip|easy_install)\s|setup\.py\s+install')
+
+
+def run_bash(command, cwd, name=None):
+    p = subprocess.Popen(['bash', '-c', command], cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0].splitlines()
+    return p.returncode, output
+
+
+class LocalShell(object):
+    def __init__(self, package_lock=None, pip_lock=None, run=run_bash):
+        self.home = os.path.expanduser('~')
+        self.package_lock = package_lock
+        self.pip_lock = pip_lock
+        self.run = run
+        self._last_status = 0
+
+    def _path(self, path):
+        return os.path.join(self.home, path)
+
+    def execute(self, command, silent=True, only_printable=False,
+                ignore_exit_status=False, log_output=True, detach=False,
+                source_profile=True, raise_on_failure=True):
+        # always taken in this order, as a command may need both
+        locks = [lock for lock, pattern in ((self.package_lock, PACKAGE_COMMAND_RE),
+                                            (self.pip_lock, PIP_COMMAND_RE))
+                 if lock and pattern.search(command)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            return self._execute(command, silent, ignore_exit_status,
+                                 source_profile, raise_on_failure)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _execute(self, command, silent, ignore_exit_status, source_profile,
+                 raise_on_failure):
+        name = command
+        if source_profile:
+            command = 'source /etc/profile && ' + command
+        status, output = self.run(command, self.home, name)
+        self._last_status = status
+        if not silent:
+            for line in output:
+                print line
+        if status != 0 and not ignore_exit_status and raise_on_failure:
+            raise exception.RemoteCommandFailed(
+                "command '%s' failed with status %d" % (command, status),
+                command, status, '\n'.join(output))
+        return output
+
+    def get_last_status(self):
+        return self._last_status
+
+    def remote_file(self, file, mode='w'):
+        return open(self._path(file), mode)
+
+    def put(self, localpaths, remotepath='.'):
+        paths = localpaths if isinstance(localpaths, list) else [localpaths]
+        for path in paths:
+            shutil.copy(path, self._path(remotepath))
+
+    def get(self, remotepaths, localpath=''):
+        paths = remotepaths if isinstance(remotepaths, list) else [remotepaths]
+        for path in paths:
+            shutil.copy(self._path(path), localpath or os.getcwd())
+
+    def isfile(self, path):
+        return os.path.isfile(self._path(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self._path(path))
+
+    def path_exists(self, path):
+        return os.path.exists(self._path(path))
+
+
+class LocalNode(object):
+    def __init__(self, package_lock=None, pip_lock=None, run=run_bash):
+        self.alias = socket.gethostname()
+        self.dns_name = self.alias
+        self.ssh = LocalShell(package_lock, pip_lock, run)
+
+    def apt_command(self, cmd):
+        dpkg_opts = "Dpkg::Options::='--force-confnew'"
+        cmd = "apt-get -o %s -y --force-yes %s" % (dpkg_opts, cmd)
+        self.ssh.execute("DEBIAN_FRONTEND='noninteractive' " + cmd)
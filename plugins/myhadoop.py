@@ -2,7 +2,20 @@ from starcluster import threadpool
 from starcluster import clustersetup
 from starcluster.logger import log
 
+import inspect
 import posixpath
+import re
+import time
+
+import checkpoint
+import clusterutils
+import configbundle
+import daemonlauncher
+import diskprep
+import nodeprobe
+import stackmanifest
+import stepgraph
+import tracing
 
 # Installs Hadoop 2.x a la
 # http://codesfusion.blogspot.com/2013/10/setup-hadoop-2x-220-on-ubuntu.html
@@ -33,6 +46,14 @@ core_site_templ = """\
     <name>hadoop.tmp.dir</name>
     <value>%(hadoop_tmpdir)s</value>
   </property>
+  <property>
+    <name>net.topology.script.file.name</name>
+    <value>%(hadoop_home)s/etc/hadoop/topology.sh</value>
+  </property>
+  <property>
+    <name>io.compression.codecs</name>
+    <value>%(codecs)s</value>
+  </property>
 </configuration>
 """
 
@@ -44,17 +65,25 @@ hdfs_site_templ = """\
      <name>dfs.replication</name>
      <value>%(replication)d</value>
    </property>
+   <property>
+     <name>dfs.blocksize</name>
+     <value>%(block_size)s</value>
+   </property>
    <property>
      <name>dfs.permissions</name>
      <value>false</value>
    </property>
    <property>
      <name>dfs.namenode.name.dir</name>
-     <value>file:/mnt/hdfs/%(user)s/namenode</value>
+     <value>file:%(namenode_dir)s</value>
    </property>
    <property>
      <name>dfs.datanode.data.dir</name>
-     <value>file:/mnt/hdfs/%(user)s/datanode</value>
+     <value>%(datanode_dirs)s</value>
+   </property>
+   <property>
+     <name>dfs.hosts.exclude</name>
+     <value>%(hadoop_home)s/etc/hadoop/excludes</value>
    </property>
  </configuration>
  """
@@ -66,6 +95,14 @@ mapred_site_templ = """\
    <name>mapreduce.framework.name</name>
    <value>yarn</value>
  </property>
+ <property>
+   <name>mapreduce.map.output.compress</name>
+   <value>%(map_output_compress)s</value>
+ </property>
+ <property>
+   <name>mapreduce.map.output.compress.codec</name>
+   <value>%(map_output_codec)s</value>
+ </property>
 </configuration>
 """
 
@@ -74,12 +111,20 @@ yarn_site_templ = """\
  <configuration>
   <property>
     <name>yarn.nodemanager.aux-services</name>
-    <value>mapreduce_shuffle</value>
+    <value>%(aux_services)s</value>
   </property>
   <property>
     <name>yarn.nodemanager.aux-services.mapreduce.shuffle.class</name>
     <value>org.apache.hadoop.mapred.ShuffleHandler</value>
   </property>
+  <property>
+    <name>yarn.nodemanager.aux-services.spark_shuffle.class</name>
+    <value>org.apache.spark.network.yarn.YarnShuffleService</value>
+  </property>
+  <property>
+    <name>yarn.nodemanager.local-dirs</name>
+    <value>%(nodemanager_local_dirs)s</value>
+  </property>
   <property>
     <name>yarn.resourcemanager.resource-tracker.address</name>
     <value>%(master)s:8025</value>
@@ -92,98 +137,181 @@ yarn_site_templ = """\
     <name>yarn.resourcemanager.address</name>
     <value>%(master)s:8040</value>
   </property>
+  <property>
+    <name>yarn.nodemanager.resource.memory-mb</name>
+    <value>%(nodemanager_memory_mb)d</value>
+  </property>
+  <property>
+    <name>yarn.nodemanager.resource.cpu-vcores</name>
+    <value>%(nodemanager_vcores)d</value>
+  </property>
+  <property>
+    <name>yarn.scheduler.minimum-allocation-mb</name>
+    <value>%(min_allocation_mb)d</value>
+  </property>
+  <property>
+    <name>yarn.scheduler.maximum-allocation-mb</name>
+    <value>%(max_allocation_mb)d</value>
+  </property>
+  <property>
+    <name>yarn.scheduler.maximum-allocation-vcores</name>
+    <value>%(max_allocation_vcores)d</value>
+  </property>
+  <property>
+    <name>yarn.resourcemanager.nodes.exclude-path</name>
+    <value>%(hadoop_home)s/etc/hadoop/excludes</value>
+  </property>
  </configuration>
  """
- 
+
+# Hadoop asks for the racks of a batch of hosts or IPs at once and expects
+# one rack per argument, in order
+topology_script = """\
+#!/bin/bash
+MAP=`dirname $0`/topology.data
+for host in "$@"; do
+  rack=`awk -v host="$host" '$1 == host {print $2; exit}' $MAP`
+  echo ${rack:-/default-rack}
+done
+"""
+
+# Hadoop's default HADOOP_HEAPSIZE, held back on every node for each daemon
+DAEMON_HEAP_MB = 1000
+# YARN rounds every container request up to a multiple of this
+MIN_ALLOCATION_MB = 1024
+
+
+def nodemanager_memory_mb(resources, is_master, daemon_heap_mb=DAEMON_HEAP_MB):
+    """
+    The memory a node's NodeManager hands out to containers: what is left
+    after the OS and the datanode and nodemanager heaps, and on the master
+    the namenode and resourcemanager heaps as well
+    """
+    return resources.usable_memory_mb(daemon_heap_mb * (4 if is_master else 2))
+
 class HadoopInstaller(clustersetup.ClusterSetup):
     """
     Configures Hadoop according to 
     https://raseshmori.wordpress.com/2012/10/14/install-hadoop-nextgen-yarn-multi-node-cluster/
     Installs from source if necessary
+    Nodes can be added and removed while HDFS and YARN are running; removed
+    datanodes are decommissioned first, waiting up to decommission_timeout
+    seconds for their blocks to be re-replicated
+    Blank instance-store disks are formatted and mounted as extra data
+    volumes first, one per disk with disk_layout='jbod', as one RAID0 array
+    with 'raid0', or not at all with 'none'; new volumes get a quick
+    throughput check, and with disk_benchmark=True every data volume does
+    HDFS places replicas by rack, where a node's rack is its EC2
+    availability zone and placement group; replication and block_size
+    (e.g. '128m') are passed to HDFS as they are
+    spark_shuffle registers Spark's external shuffle service with the
+    NodeManagers, for SparkInstaller's cluster_manager='yarn'; its jar is
+    put in place by SparkInstaller
+    trace_file, if given, is where the provisioning timeline is written
     """
 
-    def __init__(self, hadoop_tmpdir='/mnt/hadoop'):
+    def __init__(self, hadoop_tmpdir='/mnt/hadoop', apt_proxy=True,
+                 decommission_timeout=3600, trace_file=None, disk_layout='jbod',
+                 replication=2, block_size='128m', spark_shuffle=False,
+                 disk_benchmark=False):
+        if disk_layout not in diskprep.LAYOUTS:
+            raise ValueError("disk_layout must be one of %s, got %r"
+                             % (', '.join(diskprep.LAYOUTS), disk_layout))
+        self.disk_layout = disk_layout
+        self.disk_benchmark = clusterutils.as_bool(disk_benchmark)
+        self.replication = int(replication)
+        self.block_size = block_size
+        self.spark_shuffle = clusterutils.as_bool(spark_shuffle)
         self.hadoop_tmpdir = hadoop_tmpdir
+        self.apt_proxy = clusterutils.as_bool(apt_proxy)
+        self.decommission_timeout = int(decommission_timeout)
+        self.daemon_heap_mb = DAEMON_HEAP_MB
+        if trace_file:
+            tracing.enable(trace_file)
         self.hadoop_home = '/usr/local/hadoop'
         self.hadoop_conf = self.hadoop_home + '/etc/hadoop'
         self._pool = None
         self.ubuntu_javas = ['/usr/lib/jvm/java-7-openjdk-amd64']
+        self.protobuf_version = '2.5.0'
+        self.protobuf_source = 'http://protobuf.googlecode.com/files/protobuf-2.5.0.tar.gz'
+        self.hadoop_version = '2.5.2'
+        self.hadoop_source = 'http://www.interior-dsgn.com/apache/hadoop/common/hadoop-2.5.2/hadoop-2.5.2-src.tar.gz'
+        self.package_revision = 'starcluster1'
+        self.build_dir = '/tmp/hadoop-build'
 
     @property
     def pool(self):
         if self._pool is None:
             self._pool = threadpool.get_thread_pool(20, disable_threads=False)
-        return self._pool
+        return tracing.TracedPool(self._pool)
 
     def _get_java_home(self, node):
         for java in self.ubuntu_javas:
             if node.ssh.isdir(java):
                 return java
-            raise Exception("Can't find JAVA home")
+        raise Exception("Can't find JAVA home")
 
-    def _setup_hadoop_user(self, node, user):
-        node.ssh.execute("gpasswd -a %s hadoop" % user)
+    def _setup_hadoop_user(self, bundle, user):
+        bundle.add_command("gpasswd -a %s hadoop" % user)
 
-    def _setup_hadoop_config(self, node):
+    def _setup_hadoop_config(self, bundle, java_home):
         hadoop_config_file = posixpath.join(self.hadoop_home, 'libexec/hadoop-config.sh')
-        node.ssh.execute('mv {0} {0}.old'.format(hadoop_config_file))
-        fin = node.ssh.remote_file(hadoop_config_file + '.old', 'r')
-        fout = node.ssh.remote_file(hadoop_config_file, 'w')
-        fout.write('export JAVA_HOME=%s\n'% self._get_java_home(node))
-        for line in fin:
-            fout.write(line)
-        fin.close()
-        fout.close()
+        bundle.prepend_line(hadoop_config_file, 'export JAVA_HOME=%s' % java_home)
 
-    def _setup_yarn_env(self, node, cfg):
+    def _setup_yarn_env(self, bundle, java_home):
         env_file = posixpath.join(self.hadoop_home, 'etc/hadoop/yarn-env.sh')
-        node.ssh.execute('mv {0} {0}.old'.format(env_file))
-        fout = node.ssh.remote_file(env_file, 'w')
-        fin = node.ssh.remote_file(env_file + '.old', 'r')
-        fout.write('export JAVA_HOME=%s\n' % self._get_java_home(node))
-        for line in fin:
-            fout.write(line)
-        fin.close()
-        fout.close()
+        bundle.prepend_line(env_file, 'export JAVA_HOME=%s' % java_home)
 
-    def _setup_core_site(self, node, cfg):
+    def _setup_core_site(self, bundle, cfg):
         fname = posixpath.join(self.hadoop_home, 'etc/hadoop/core-site.xml')
-        fout = node.ssh.remote_file(fname, 'w')
-        fout.write(core_site_templ % cfg)
-        fout.close()
+        bundle.add_file(fname, core_site_templ % cfg)
 
-    def _setup_hdfs_site(self, node, cfg):
+    def _setup_hdfs_site(self, bundle, cfg):
         fname = posixpath.join(self.hadoop_home, 'etc/hadoop/hdfs-site.xml')
-        fout = node.ssh.remote_file(fname, 'w')
-        fout.write(hdfs_site_templ % cfg)
-        fout.close()
+        bundle.add_file(fname, hdfs_site_templ % cfg)
 
-    def _setup_mapred_site(self, node, cfg):
+    def _setup_mapred_site(self, bundle, cfg):
         fname = posixpath.join(self.hadoop_home, 'etc/hadoop/mapred-site.xml')
-        fout = node.ssh.remote_file(fname, 'w')
-        fout.write(mapred_site_templ)
-        fout.close()
+        bundle.add_file(fname, mapred_site_templ % cfg)
 
-    def _setup_yarn_site(self, node, cfg):
+    def _setup_yarn_site(self, bundle, cfg):
         fname = posixpath.join(self.hadoop_home, 'etc/hadoop/yarn-site.xml')
-        fout = node.ssh.remote_file(fname, 'w')
-        fout.write(yarn_site_templ % cfg)
-        fout.close()
+        bundle.add_file(fname, yarn_site_templ % cfg)
 
-    def _setup_slaves(self, node, nodelist):
+    def _setup_slaves(self, bundle, nodelist):
         fname = posixpath.join(self.hadoop_home, 'etc/hadoop/slaves')
-        fout = node.ssh.remote_file(fname, 'w')
-        for name in nodelist:
-            fout.write(name + "\n")
-        fout.close()
+        bundle.add_file(fname, ''.join(name + "\n" for name in nodelist))
+        # the namenode and resourcemanager refuse to start without it
+        bundle.add_command('touch %s' % posixpath.join(self.hadoop_home, 'etc/hadoop/excludes'))
+
+    def _rack(self, node):
+        # one level deep, like /default-rack: the namenode refuses to mix
+        # racks of different depths
+        rack = '/' + node.instance.placement
+        if node.instance.placement_group:
+            rack += '-' + node.instance.placement_group
+        return rack
+
+    def _topology_lines(self, node):
+        # Hadoop resolves datanodes by IP and clients by name
+        rack = self._rack(node)
+        return ['%s %s' % (host, rack)
+                for host in (node.private_ip_address, node.alias, node.dns_name)]
+
+    def _setup_topology(self, bundle, lines):
+        fname = posixpath.join(self.hadoop_conf, 'topology.sh')
+        bundle.add_file(fname, topology_script, 0755)
+        fname = posixpath.join(self.hadoop_conf, 'topology.data')
+        bundle.add_file(fname, ''.join(line + "\n" for line in lines))
         
-    def _create_hdfs(self, node, user, cfg):
-        node.ssh.execute('mkdir -p %(hadoop_tmpdir)s' % cfg)
-        node.ssh.execute('mkdir -p /mnt/hdfs/%(user)s/namenode' % cfg)
-        node.ssh.execute('mkdir -p /mnt/hdfs/%(user)s/datanode' % cfg)
-        node.ssh.execute('chown -R {0}:hadoop {1}'.format(user, cfg['hadoop_tmpdir']))
-        node.ssh.execute('chown -R {0}:hadoop /mnt/hdfs/{0}/namenode'.format(user))
-        node.ssh.execute('chown -R {0}:hadoop /mnt/hdfs/{0}/datanode'.format(user))
+    def _create_hdfs(self, bundle, user, cfg):
+        dirs = ' '.join([cfg['hadoop_tmpdir']] + cfg['local_dirs'])
+        bundle.add_command('mkdir -p %s' % dirs)
+        bundle.add_command('chown -R {0}:hadoop {1}'.format(user, dirs))
+
+    def _run_as_user(self, node, user, command, **kwargs):
+        return node.ssh.execute('su -l %s -c "source /home/%s/sethadoopenv.sh; %s"'
+                                % (user, user, command), **kwargs)
 
     def _format_namenode(self, master, user):
         master.ssh.execute(' '.join( 
@@ -192,43 +320,45 @@ class HadoopInstaller(clustersetup.ClusterSetup):
              posixpath.join(self.hadoop_home, 'bin/hdfs'),
              ' namenode -format -force "']))
 
-    def _setup_user_env(self, node, user, cfg):
+    def _setup_user_env(self, bundle, user, cfg):
         env_file = posixpath.join('/home/%s' % user, 'sethadoopenv.sh')
-        fout = node.ssh.remote_file(env_file, 'w')
-        fout.write(user_env_templ % cfg)
-        fout.close()
+        bundle.add_file(env_file, user_env_templ % cfg)
 
         env_file = posixpath.join('/home/%s' % user, '.bashrc')
-        fout = node.ssh.remote_file(env_file, 'a')
-        fout.write('source $HOME/sethadoopenv.sh\n')
-        fout.close()
+        bundle.append_line(env_file, 'source $HOME/sethadoopenv.sh')
+
+    def _daemon(self, user, script, name, port=None, action='start'):
+        return daemonlauncher.Daemon(
+            name, port, 'su -l %s -c "source /home/%s/sethadoopenv.sh; '
+                        '\\$HADOOP_HOME/sbin/%s %s %s"' % (user, user, script, action, name))
 
     def _write_hadoop_scripts(self, master, user):
+        # the master daemons come up first, then the datanodes and
+        # nodemanagers on every node in the slaves file at once
+        masters = [self._daemon(user, 'hadoop-daemon.sh', 'namenode', 9000),
+                   self._daemon(user, 'yarn-daemon.sh', 'resourcemanager', 8040),
+                   self._daemon(user, 'mr-jobhistory-daemon.sh', 'historyserver', 10020)]
+        workers = [self._daemon(user, 'hadoop-daemon.sh', 'datanode', 50010),
+                   self._daemon(user, 'yarn-daemon.sh', 'nodemanager', 8042)]
         fname = '/home/starthadoop-%s.sh' % user
         fout = master.ssh.remote_file(fname, 'w')
-        fout.write("""\
-su -l {0} -c "\
-source /home/{0}/sethadoopenv.sh;\
-\$HADOOP_HOME/sbin/hadoop-daemon.sh start namenode;\
-\$HADOOP_HOME/sbin/hadoop-daemons.sh start datanode;\
-\$HADOOP_HOME/sbin/yarn-daemon.sh start resourcemanager;\
-\$HADOOP_HOME/sbin/yarn-daemons.sh start nodemanager;\
-\$HADOOP_HOME/sbin/mr-jobhistory-daemon.sh start historyserver"
-""".format(user))
+        fout.write(daemonlauncher.script('Hadoop', [
+            ([master.alias], masters),
+            (posixpath.join(self.hadoop_conf, 'slaves'), workers)]))
         fout.close()
         master.ssh.execute('chmod +x ' + fname)
 
+        # and stopped the other way round, every worker at once
+        workers = [self._daemon(user, 'yarn-daemon.sh', 'nodemanager', action='stop'),
+                   self._daemon(user, 'hadoop-daemon.sh', 'datanode', action='stop')]
+        masters = [self._daemon(user, 'mr-jobhistory-daemon.sh', 'historyserver', action='stop'),
+                   self._daemon(user, 'yarn-daemon.sh', 'resourcemanager', action='stop'),
+                   self._daemon(user, 'hadoop-daemon.sh', 'namenode', action='stop')]
         fname = '/home/stophadoop-%s.sh' % user
         fout = master.ssh.remote_file(fname, 'w')
-        fout.write("""\
-su -l {0} -c "\
-source /home/{0}/sethadoopenv.sh;\
-\$HADOOP_HOME/sbin/mr-jobhistory-daemon.sh stop historyserver\
-\$HADOOP_HOME/sbin/yarn-daemons.sh stop nodemanager;\
-\$HADOOP_HOME/sbin/yarn-daemon.sh stop resourcemanager;\
-\$HADOOP_HOME/sbin/hadoop-daemons.sh stop datanode;\
-\$HADOOP_HOME/sbin/hadoop-daemon.sh stop namenode;"
-""".format(user))
+        fout.write(daemonlauncher.stop_script('Hadoop', [
+            (posixpath.join(self.hadoop_conf, 'slaves'), workers),
+            ([master.alias], masters)]))
         fout.close()
         master.ssh.execute('chmod +x ' + fname)
 
@@ -241,149 +371,409 @@ source /home/{0}/sethadoopenv.sh;\
                 if not has_perm:
                     ec2.conn.authorize_security_group(group_id=group.id, ip_protocol='tcp', from_port=port, to_port=port, cidr_ip='0.0.0.0/0')
 
-    def _configure_hadoop(self, master, nodes, user):
+    def _size_node(self, cfg, resources, is_master):
+        node_cfg = dict(cfg)
+        node_cfg['nodemanager_memory_mb'] = nodemanager_memory_mb(resources, is_master,
+                                                                  self.daemon_heap_mb)
+        node_cfg['nodemanager_vcores'] = resources.usable_cores()
+        return node_cfg
+
+    def _place_dirs(self, cfg, resources):
+        # datanode blocks and NodeManager scratch space are striped over
+        # every local data volume; the namenode keeps its metadata on the
+        # first one
+        user = cfg['user']
+        namenode_dir = resources.local_dirs('hdfs/%s/namenode' % user)[0]
+        datanode_dirs = resources.local_dirs('hdfs/%s/datanode' % user)
+        local_dirs = resources.local_dirs('yarn/%s/local' % user)
+        node_cfg = dict(cfg)
+        node_cfg['namenode_dir'] = namenode_dir
+        node_cfg['datanode_dirs'] = ','.join('file:' + d for d in datanode_dirs)
+        node_cfg['nodemanager_local_dirs'] = ','.join(local_dirs)
+        node_cfg['local_dirs'] = [namenode_dir] + datanode_dirs + local_dirs
+        return node_cfg
+
+    def _configure_node(self, node, user, cfg, node_aliases, resources):
+        # everything a node needs before HDFS can be formatted is rendered
+        # here and installed with a single transfer, so a slow node only
+        # delays itself
+        cfg = self._size_node(cfg, resources, node.alias == cfg['master'])
+        cfg = self._place_dirs(cfg, resources)
+        java_home = self._get_java_home(node)
+        bundle = configbundle.ConfigBundle()
+        self._setup_hadoop_user(bundle, user)
+        self._setup_hadoop_config(bundle, java_home)
+        self._setup_yarn_env(bundle, java_home)
+        self._setup_core_site(bundle, cfg)
+        self._setup_hdfs_site(bundle, cfg)
+        self._setup_mapred_site(bundle, cfg)
+        self._setup_yarn_site(bundle, cfg)
+        self._setup_slaves(bundle, node_aliases)
+        self._setup_topology(bundle, cfg['topology'])
+        self._setup_user_env(bundle, user, cfg)
+        self._create_hdfs(bundle, user, cfg)
+        bundle.push(node)
+        log.info("...configured %s" % node.alias)
+
+    def _native_libs(self, node):
+        """Which native libraries hadoop checknative can load on node"""
+        out = node.ssh.execute('JAVA_HOME=%s %s checknative -a 2>&1'
+                               % (self._get_java_home(node),
+                                  posixpath.join(self.hadoop_home, 'bin/hadoop')),
+                               ignore_exit_status=True)
+        libs = {}
+        for line in out:
+            match = re.match(r'^\s*(\w+):\s+(true|false)\b', line)
+            if match:
+                libs[match.group(1)] = match.group(2) == 'true'
+        return libs
+
+    def _missing_snappy(self, nodes):
+        """The aliases of the nodes that can't load native Snappy"""
+        libs = clusterutils.map_nodes(self.pool, nodes, self._native_libs)
+        return sorted(alias for alias, found in libs.items()
+                      if not (found.get('hadoop') and found.get('snappy')))
+
+    def _compression_cfg(self, snappy):
+        codecs = ['org.apache.hadoop.io.compress.DefaultCodec',
+                  'org.apache.hadoop.io.compress.GzipCodec',
+                  'org.apache.hadoop.io.compress.BZip2Codec']
+        if snappy:
+            codecs.append('org.apache.hadoop.io.compress.SnappyCodec')
+        return {'codecs': ','.join(codecs),
+                'map_output_compress': 'true' if snappy else 'false',
+                'map_output_codec': codecs[-1] if snappy else codecs[0]}
+
+    def _get_cfg(self, master, user):
+        return {'master':master.alias, 
+                'user':user,
+                'replication': self.replication,
+                'block_size': self.block_size,
+                'min_allocation_mb': MIN_ALLOCATION_MB,
+                'aux_services': 'mapreduce_shuffle,spark_shuffle' if self.spark_shuffle
+                                else 'mapreduce_shuffle',
+                'hadoop_home' : self.hadoop_home,
+                'hadoop_tmpdir': posixpath.join(self.hadoop_tmpdir, 'hadoop-%s' % user)}
+
+    def _configure_hadoop(self, master, nodes, user, volumes):
         log.info("Configuring Hadoop...")
 
-        log.info("Adding user %s to hadoop group" % user)
-        for node in nodes:
-            self.pool.simple_job(self._setup_hadoop_user, (node, user), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
         node_aliases = map(lambda n: n.alias, nodes)
-        cfg = {'master':master.alias, 
-               'user':user,
-               'replication':2,
-               'hadoop_home' : self.hadoop_home,
-               'hadoop_tmpdir': posixpath.join(self.hadoop_tmpdir, 'hadoop-%s' % user)}
-
-        log.info("Installing configuration templates...")
-        for node in nodes:
-            self.pool.simple_job(self._setup_hadoop_config, (node, ), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        for node in nodes:
-            self.pool.simple_job(self._setup_yarn_env, (node, cfg), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        for node in nodes:
-            self.pool.simple_job(self._setup_core_site, (node, cfg), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        for node in nodes:
-            self.pool.simple_job(self._setup_hdfs_site, (node, cfg), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        for node in nodes:
-            self.pool.simple_job(self._setup_mapred_site, (node, cfg), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        for node in nodes:
-            self.pool.simple_job(self._setup_yarn_site, (node, cfg), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        log.info('Configuring slaves')
-        for node in nodes:
-            self.pool.simple_job(self._setup_slaves, (node, node_aliases), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        log.info("Setting up user environment")
-        for node in nodes:
-            self.pool.simple_job(self._setup_user_env, (node, user, cfg), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        log.info("Creating HDFS")
+        cfg = self._get_cfg(master, user)
+
+        log.info("Preparing instance-store disks (%s) and sizing NodeManagers "
+                 "to each node's hardware" % self.disk_layout)
+        resources = diskprep.prepare_all(self.pool, nodes, self.disk_layout,
+                                         nodeprobe.volume_mounts(volumes),
+                                         self.disk_benchmark)
+        sizes = [self._size_node(cfg, r, alias == master.alias) for alias, r in resources.items()]
+        cfg['max_allocation_mb'] = max(size['nodemanager_memory_mb'] for size in sizes)
+        cfg['max_allocation_vcores'] = max(size['nodemanager_vcores'] for size in sizes)
+        cfg['topology'] = sum([self._topology_lines(n) for n in nodes], [])
+        log.info("Racks: %s" % ', '.join(sorted(set(self._rack(n) for n in nodes))))
+
+        # map output compressed with Snappy on one node has to be readable
+        # by the reducers on every other
+        log.info("Checking native compression libraries")
+        missing = self._missing_snappy(nodes)
+        if missing:
+            log.warn("No native Snappy on %s: leaving map output uncompressed"
+                     % ', '.join(missing))
+        cfg.update(self._compression_cfg(not missing))
+
+        log.info("Adding %s to the hadoop group, installing configuration "
+                 "templates and creating HDFS directories" % user)
         for node in nodes:
-            self.pool.simple_job(self._create_hdfs, (node, user, cfg), jobid=node.alias)
+            self.pool.simple_job(self._configure_node, (node, user, cfg, node_aliases, resources[node.alias]),
+                                 jobid=node.alias)
         self.pool.wait(numtasks=len(nodes))
 
         self._format_namenode(master, user)
 
-#        unnecessary: use start-/stop-dfs.sh and start-/stop-yarn.sh
-#        log.info("Writing launch/end scripts")
-#        self._write_hadoop_scripts(master, user)
-
-    def _hadoop_installedq(self, node):
-        return node.ssh.path_exists(self.hadoop_home)
+        log.info("Writing launch/end scripts")
+        self._write_hadoop_scripts(master, user)
 
     def _create_hadoop_group(self, node):
-        node.ssh.execute('groupadd hadoop')
+        node.ssh.execute('getent group hadoop > /dev/null || groupadd hadoop')
 
     def _install_apts(self, node):
         apt_packages = ['maven', 'cmake', 'pkg-config', 'libssl-dev', 'snappy',
                         'libsnappy-dev', 'libbz2-dev', 'libjansson-dev',
-                        'libfuse-dev']
-        for pkg in apt_packages:
-            node.apt_command('install %s' % pkg)
+                        'libfuse-dev', 'dpkg-dev']
+        node.apt_command('install %s' % ' '.join(apt_packages))
         node.apt_command('clean')
 
-    def _install_protobuf(self, node):
+    def _package_version(self, version):
+        return '%s-%s' % (version, self.package_revision)
+
+    def _build_protobuf_deb(self, master):
+        version = self._package_version(self.protobuf_version)
         instructions = """\
-wget http://protobuf.googlecode.com/files/protobuf-2.5.0.tar.gz;
-tar zvxf protobuf-2.5.0.tar.gz;
-cd protobuf-2.5.0;
-./configure;
-make;
-make check;
-sudo make install;
-sudo ldconfig;
-cd ~
-rm -rf protobuf-2.5.0*
+set -e
+rm -rf {build}
+mkdir -p {build}
+cd {build}
+wget -O protobuf.tar.gz {source}
+tar zxf protobuf.tar.gz
+cd protobuf-{version}
+./configure --prefix=/usr/local
+make
+make check
+make install DESTDIR={build}/staging
 """
-        node.ssh.execute(instructions) 
-
-    def _build_hadoop(self, node):
+        master.ssh.execute(instructions.format(build=self.build_dir,
+                                               source=self.protobuf_source,
+                                               version=self.protobuf_version))
+        deb = clusterutils.build_deb(master, posixpath.join(self.build_dir, 'staging'),
+                                     'starcluster-protobuf', version,
+                                     'libc6, libstdc++6',
+                                     'Protocol Buffers %s for building Hadoop' % self.protobuf_version,
+                                     postinst='ldconfig\n')
+        master.ssh.execute('rm -rf %s' % self.build_dir)
+        # the Hadoop build needs protoc on the master
+        master.ssh.execute('dpkg -i %s' % deb)
+
+    def _build_hadoop_deb(self, master):
+        version = self._package_version(self.hadoop_version)
         instructions = """\
-wget http://www.interior-dsgn.com/apache/hadoop/common/hadoop-2.5.2/hadoop-2.5.2-src.tar.gz
-tar xzvf hadoop-2.5.2-src.tar.gz
-cd hadoop-2.5.2-src
-mvn clean
-MAVEN_OPTS="-Xmx2g -XX:MaxPermSize=512M -XX:ReservedCodeCacheSize=512M" mvn compile -Pnative -Drequire.snappy -Drequire.openssl
-mvn package -Pdist,native -DskipTests
-cp -r hadoop-dist/target/hadoop-2.5.2 {0}
-chown -R :hadoop {0}
-cd ~
-rm -rf hadoop*
-""" 
-        node.ssh.execute(instructions.format(self.hadoop_home))
+set -e
+rm -rf {build}
+mkdir -p {build}
+cd {build}
+wget -O hadoop-src.tar.gz {source}
+tar xzf hadoop-src.tar.gz
+cd hadoop-{version}-src
+mvn {maven} clean
+MAVEN_OPTS="-Xmx2g -XX:MaxPermSize=512M -XX:ReservedCodeCacheSize=512M" mvn {maven} compile -Pnative -Drequire.snappy -Drequire.openssl
+mvn {maven} package -Pdist,native -DskipTests
+mkdir -p {build}/staging{parent}
+cp -r hadoop-dist/target/hadoop-{version} {build}/staging{home}
+"""
+        maven_key = 'hadoop-' + checkpoint.digest(self.hadoop_source)[:12]
+        maven = clusterutils.maven_args(master, maven_key,
+                                        nodeprobe.probe(master).build_jobs())
+        master.ssh.execute(instructions.format(build=self.build_dir,
+                                               source=self.hadoop_source,
+                                               version=self.hadoop_version,
+                                               maven=maven,
+                                               parent=posixpath.dirname(self.hadoop_home),
+                                               home=self.hadoop_home))
+        clusterutils.build_deb(master, posixpath.join(self.build_dir, 'staging'),
+                               'starcluster-hadoop', version,
+                               'starcluster-protobuf, libsnappy1 | libsnappy1v5, '
+                               'libssl1.0.0, libbz2-1.0, zlib1g',
+                               'Hadoop %s with native libraries' % self.hadoop_version,
+                               postinst='getent group hadoop > /dev/null || groupadd hadoop\n'
+                                        'chown -R :hadoop %s\n' % self.hadoop_home)
+        clusterutils.mark_maven_seeded(master, maven_key)
+        master.ssh.execute('rm -rf %s' % self.build_dir)
+
+    def _install_hadoop_packages(self, node, master):
+        if self.apt_proxy:
+            clusterutils.use_apt_proxy(node, master)
+        clusterutils.add_apt_repo(node, master)
+        node.apt_command('install --reinstall starcluster-hadoop')
 
     def _chown_hadoop(self, node, user):
         node.ssh.execute("chown -R {0} {1}".format(user, self.hadoop_home) )
 
-    def _install_hadoop(self, master, nodes, user):
-        if self._hadoop_installedq(master):
+    def _package_graph(self):
+        # the packages are only rebuilt on the master when these inputs change
+        steps = [
+            ('build_deps', self._install_apts, [], []),
+            ('protobuf_deb', self._build_protobuf_deb, ['build_deps'],
+             [self.protobuf_source, self.protobuf_version]),
+            ('hadoop_deb', self._build_hadoop_deb, ['protobuf_deb'],
+             [self.hadoop_source, self.hadoop_version, self.hadoop_home]),
+        ]
+        return stepgraph.StepGraph(
+            stepgraph.Step(name, method, deps,
+                           [inspect.getsource(method), self.package_revision] + inputs)
+            for name, method, deps, inputs in steps)
+
+    def bake_image(self, node):
+        """Builds and installs the Hadoop packages on a single node that is
+        being saved as an image"""
+        graph = self._package_graph()
+        graph.run(node, 1, checkpoint.Checkpoints(node, 'hadoop-packages'))
+        deb = clusterutils.apt_repo_path('starcluster-hadoop_%s_*.deb'
+                                         % self._package_version(self.hadoop_version))
+        # dpkg leaves missing dependencies for apt-get -f to pull in
+        node.ssh.execute('dpkg -i %s' % deb, ignore_exit_status=True)
+        node.apt_command('install -f')
+        stackmanifest.record(node, 'hadoop', graph.steps[-1].digest,
+                             {'hadoop': self.hadoop_version,
+                              'protobuf': self.protobuf_version})
+
+    def _install_node(self, node, master, user, packages_digest, baked=False):
+        checkpoints = checkpoint.Checkpoints(node, 'hadoop')
+        step_digest = checkpoint.digest(packages_digest, user)
+        if checkpoints.is_done('install', step_digest):
             return
+        if not baked:
+            self._create_hadoop_group(node)
+            self._install_hadoop_packages(node, master)
+        self._chown_hadoop(node, user)
+        checkpoints.mark_done('install', step_digest)
 
+    def _install_hadoop(self, master, nodes, user):
         log.info("Installing Hadoop...")
 
-        log.info("Creating hadoop usergroup")
-        for node in nodes:
-            self.pool.simple_job(self._create_hadoop_group, (node,), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
+        graph = self._package_graph()
+        packages_digest = graph.steps[-1].digest
+        baked = stackmanifest.matching(self.pool, nodes, 'hadoop', packages_digest)
+        if baked:
+            log.info("Hadoop is already in the image on %d of %d nodes"
+                     % (len(baked), len(nodes)))
+
+        # protobuf and Hadoop are compiled once, on the master, and published
+        # as .debs so every node installs them with a single apt-get
+        if len(baked) < len(nodes):
+            log.info("Building Hadoop packages on %s" % master.alias)
+            if self.apt_proxy:
+                clusterutils.serve_apt_proxy(master)
+                clusterutils.use_apt_proxy(master, master)
+            graph.run(master, 1, checkpoint.Checkpoints(master, 'hadoop-packages'))
+            clusterutils.index_apt_repo(master)
+            clusterutils.serve_artifacts(master)
+            log.info("Installing Hadoop packages from %s" % master.alias)
 
-        log.info("Installing apt packages")
         for node in nodes:
-            self.pool.simple_job(self._install_apts, (node,), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-        
-        log.info("Installing protobuf")
-        for node in nodes:
-            self.pool.simple_job(self._install_protobuf, (node,), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        log.info("Building Hadoop...")
-        for node in nodes:
-            self.pool.simple_job(self._build_hadoop, (node, ), jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
-
-        log.info("Setting Hadoop owner to %s" % user)
-        for node in nodes:
-            self.pool.simple_job(self._chown_hadoop, (node, user), jobid=node.alias)
+            self.pool.simple_job(self._install_node,
+                                 (node, master, user, packages_digest, node.alias in baked),
+                                 jobid=node.alias)
         self.pool.wait(numtasks=len(nodes))
         
+    @tracing.traced_hook
     def run(self, nodes, master, user, shell, volumes):
         self._install_hadoop(master, nodes, user)
-        self._configure_hadoop(master, nodes, user)
+        self._configure_hadoop(master, nodes, user, volumes)
         self._open_ports(master)
         log.info("Job tracker status: http://%s:50030" % master.dns_name)
         log.info("Namenode status: http://%s:50070" % master.dns_name)
 
+
+    def _namenode_runningq(self, master):
+        return clusterutils.process_running(master, 'namenode[.]NameNode')
+
+    def _refresh_nodes(self, master, user):
+        self._run_as_user(master, user, 'hdfs dfsadmin -refreshNodes')
+        self._run_as_user(master, user, 'yarn rmadmin -refreshNodes')
+
+    def _decommission_status(self, master, user, alias):
+        report = self._run_as_user(master, user, 'hdfs dfsadmin -report')
+        current = None
+        for line in report:
+            line = line.strip()
+            if line.startswith('Name:'):
+                current = None
+                if '(%s)' % alias in line:
+                    current = alias
+            elif line.startswith('Hostname:'):
+                current = line.split(':', 1)[1].strip()
+            elif line.startswith('Decommission Status') and current == alias:
+                return line.split(':', 1)[1].strip()
+        return None
+
+    def _decommission(self, master, user, alias):
+        excludes = posixpath.join(self.hadoop_conf, 'excludes')
+        clusterutils.add_line(master, excludes, alias)
+        self._refresh_nodes(master, user)
+        deadline = time.time() + self.decommission_timeout
+        while True:
+            status = self._decommission_status(master, user, alias)
+            if status in (None, 'Decommissioned'):
+                log.info("...%s decommissioned" % alias)
+                return
+            if time.time() > deadline:
+                raise Exception("%s still '%s' after %ds of decommissioning"
+                                % (alias, status, self.decommission_timeout))
+            log.info("...waiting for %s to decommission (%s)" % (alias, status))
+            time.sleep(10)
+
+    def _add_node_lines(self, node, edits):
+        for path, line in edits:
+            clusterutils.add_line(node, path, line)
+
+    def _remove_node_lines(self, node, edits):
+        for path, line in edits:
+            clusterutils.remove_line(node, path, line)
+
+    @tracing.traced_hook
+    def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Adding %s to Hadoop" % node.alias)
+        node_aliases = [n.alias for n in nodes]
+        if node.alias not in node_aliases:
+            node_aliases.append(node.alias)
+
+        graph = self._package_graph()
+        packages_digest = graph.steps[-1].digest
+        baked = stackmanifest.matches(node, 'hadoop', packages_digest)
+        if not baked:
+            # checkpointed, so the packages are only built if the master
+            # has not built or been baked with them already
+            graph.run(master, 1, checkpoint.Checkpoints(master, 'hadoop-packages'))
+            clusterutils.index_apt_repo(master)
+            clusterutils.serve_artifacts(master)
+        self._install_node(node, master, user, packages_digest, baked)
+        # the scheduler limits only matter on the master, so size them from
+        # the new node alone
+        resources = diskprep.prepare_all(self.pool, [node], self.disk_layout,
+                                         nodeprobe.volume_mounts(volumes),
+                                         self.disk_benchmark)[node.alias]
+        cfg = self._get_cfg(master, user)
+        size = self._size_node(cfg, resources, False)
+        cfg['max_allocation_mb'] = size['nodemanager_memory_mb']
+        cfg['max_allocation_vcores'] = size['nodemanager_vcores']
+        # jobs take their compression settings from the master, so the new
+        # node follows the rest of the cluster
+        mapred_site = posixpath.join(self.hadoop_conf, 'mapred-site.xml')
+        master.ssh.execute('grep -q SnappyCodec %s' % mapred_site, ignore_exit_status=True)
+        snappy = master.ssh.get_last_status() == 0
+        if snappy and self._missing_snappy([node]):
+            log.warn("No native Snappy on %s: jobs will fail there while map "
+                     "output is compressed with it" % node.alias)
+        cfg.update(self._compression_cfg(snappy))
+        topology = posixpath.join(self.hadoop_conf, 'topology.data')
+        lines = self._topology_lines(node)
+        known = [l.strip() for l in master.ssh.execute('cat %s' % topology,
+                                                        ignore_exit_status=True)]
+        cfg['topology'] = [l for l in known if l and l not in lines] + lines
+        self._configure_node(node, user, cfg, node_aliases, resources)
+
+        slaves = posixpath.join(self.hadoop_conf, 'slaves')
+        others = [n for n in nodes if n.alias != node.alias]
+        for other in others:
+            self.pool.simple_job(self._add_node_lines,
+                                 (other, [(slaves, node.alias)] + [(topology, l) for l in lines]),
+                                 jobid=other.alias)
+        self.pool.wait(numtasks=len(others))
+
+        if self._namenode_runningq(master):
+            # the alias may belong to a node decommissioned earlier
+            clusterutils.remove_line(master, posixpath.join(self.hadoop_conf, 'excludes'), node.alias)
+            self._refresh_nodes(master, user)
+            log.info("...starting datanode and nodemanager on %s" % node.alias)
+            self._run_as_user(node, user,
+                              '\\$HADOOP_HOME/sbin/hadoop-daemon.sh start datanode; '
+                              '\\$HADOOP_HOME/sbin/yarn-daemon.sh start nodemanager')
+
+    @tracing.traced_hook
+    def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Removing %s from Hadoop" % node.alias)
+        if self._namenode_runningq(master):
+            log.info("Decommissioning %s" % node.alias)
+            self._decommission(master, user, node.alias)
+            self._run_as_user(node, user,
+                              '\\$HADOOP_HOME/sbin/yarn-daemon.sh stop nodemanager; '
+                              '\\$HADOOP_HOME/sbin/hadoop-daemon.sh stop datanode',
+                              ignore_exit_status=True)
+
+        # a later node may reuse the alias or IP, so its rack goes too
+        slaves = posixpath.join(self.hadoop_conf, 'slaves')
+        topology = posixpath.join(self.hadoop_conf, 'topology.data')
+        edits = [(slaves, node.alias)] + [(topology, l) for l in self._topology_lines(node)]
+        others = [n for n in nodes if n.alias != node.alias]
+        for other in others:
+            self.pool.simple_job(self._remove_node_lines, (other, edits), jobid=other.alias)
+        self.pool.wait(numtasks=len(others))
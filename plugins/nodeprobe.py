@@ -0,0 +1,95 @@
+from starcluster.logger import log
+
+import posixpath
+
+import clusterutils
+
+# Probes a node's hardware so daemons and builds can be sized to it instead
+# of assuming one instance type for the whole cluster
+
+# the lines after cores, memory and NUMA nodes are the mount points of the
+# local block-device filesystems, the candidates for data directories
+PROBE_COMMAND = ("nproc; "
+                 "awk '/^MemTotal:/ {print $2}' /proc/meminfo; "
+                 "ls -d /sys/devices/system/node/node[0-9]* 2>/dev/null | wc -l; "
+                 "df -P -l 2>/dev/null | awk 'NR > 1 && $1 ~ /^\\/dev\\// {print $6}'")
+
+# where the data directories go when a node has no local volumes besides
+# its root filesystem
+DEFAULT_DATA_VOLUMES = ['/mnt']
+
+
+class NodeResources(object):
+    """
+    Cores, memory (in MB), NUMA nodes and local data volumes of one node,
+    plus how much of it is left for user work once the OS and the per-node
+    daemons are accounted for
+    """
+
+    def __init__(self, alias, cores, memory_mb, numa_nodes=1, data_volumes=None):
+        self.alias = alias
+        self.cores = max(1, cores)
+        self.memory_mb = memory_mb
+        self.numa_nodes = max(1, numa_nodes)
+        self.data_volumes = list(data_volumes or DEFAULT_DATA_VOLUMES)
+
+    def __repr__(self):
+        return '<NodeResources %s: %d cores, %d MB, %d NUMA nodes, volumes %s>' % (
+            self.alias, self.cores, self.memory_mb, self.numa_nodes,
+            ','.join(self.data_volumes))
+
+    @property
+    def reserved_cores(self):
+        return 1 if self.cores >= 4 else 0
+
+    @property
+    def reserved_memory_mb(self):
+        return max(1024, self.memory_mb // 10)
+
+    def usable_cores(self):
+        return max(1, self.cores - self.reserved_cores)
+
+    def usable_memory_mb(self, daemon_mb=0):
+        return max(512, self.memory_mb - self.reserved_memory_mb - daemon_mb)
+
+    def build_jobs(self):
+        # C++ compiles of Boost and Elemental want around 1GB per job
+        return max(1, min(self.cores, self.usable_memory_mb() // 1024))
+
+    def worker_instances(self):
+        # one worker per NUMA node keeps executors' memory local, provided
+        # every instance still gets a couple of cores
+        if self.numa_nodes > 1 and self.usable_cores() >= 2 * self.numa_nodes:
+            return self.numa_nodes
+        return 1
+
+    def local_dirs(self, path):
+        """path under each data volume, so I/O is striped across all of them"""
+        return [posixpath.join(volume, path.lstrip('/')) for volume in self.data_volumes]
+
+
+def volume_mounts(volumes):
+    """Mount points of the cluster's StarCluster volumes, given run()'s volumes"""
+    return [v['mount_path'] for v in (volumes or {}).values() if v.get('mount_path')]
+
+
+def _data_volumes(mounts, exclude):
+    # the root and boot filesystems hold the OS and StarCluster volumes hold
+    # user data, everything else is scratch space
+    exclude = set(m.rstrip('/') for m in exclude)
+    return sorted(m for m in mounts
+                  if m != '/' and not m.startswith('/boot') and m.rstrip('/') not in exclude)
+
+
+def probe(node, exclude=()):
+    """Probes node; exclude lists mount points not to use as data volumes"""
+    out = [line.strip() for line in node.ssh.execute(PROBE_COMMAND)]
+    resources = NodeResources(node.alias, int(out[0]), int(out[1]) // 1024,
+                              int(out[2]), _data_volumes(out[3:], exclude))
+    log.debug("probed %r" % resources)
+    return resources
+
+
+def probe_all(pool, nodes, exclude=()):
+    """Probes nodes in parallel and returns a dict of NodeResources by alias"""
+    return clusterutils.map_nodes(pool, nodes, probe, exclude)
@@ -1,19 +1,29 @@
 from starcluster.clustersetup import DefaultClusterSetup
 from starcluster.logger import log
-from itertools import chain
-import os, inspect, time
+import os, inspect, posixpath
+
+import checkpoint
+import clusterutils
+import configbundle
+import nodeprobe
+import stackmanifest
+import stepgraph
+import tracing
 
 # Assumes that the mpich2 installer has already been run to provide mpich2
 #TODO: switch using Here docs
-#TODO: support adding and removing nodes
+# Added nodes get the full per-node install from on_add_node; nothing on the
+# other nodes depends on the node list, so they are left alone
 # CAVEATS: how much free space need for this? Should start with an 8Gb disk for the total AMI, not counting actual free space you want to have at the end
-# CAVEAT: ideally, should check if skylark is already installed, and if so just exit
+# Every step leaves a checkpoint on the node holding a digest of its inputs
+# (the step's code plus the attributes listed in install_steps), so reruns
+# pick up at the first step that failed or changed
 
 class SkylarkInstaller(DefaultClusterSetup):
     SKYLARK_BASHRC = '/etc/profile.d/skylarksettings.sh'
-    nproc = "6" # number of processors to use in making (should get output of system command nproc)
 
-    # list the packages in order of install
+    # installed in a single apt transaction; autodetection of the chipset
+    # seems to fail on EC2 when building OpenBLAS, so it comes from apt too
     apt_packages = ['gfortran', 'git', 'cmake', 'libblas-dev', 'libblas3gf',
                     'liblapack-dev', 'liblapack3gf', 'libcr-dev', 'cython',
                     #'libboost-all-dev', 
@@ -23,10 +33,62 @@ class SkylarkInstaller(DefaultClusterSetup):
                     'python-nose', 'swig', 'swig-examples', 'swig2.0-examples',
                     'libhdf5-serial-dev', 'doxygen', 'graphviz',
                     'python-sphinx', 'dvipng', 'libfftw3-dev',
-                    'libfftw3-mpi-dev', 'unzip', 'subversion', 'maven'] 
+                    'libfftw3-mpi-dev', 'unzip', 'subversion', 'maven',
+                    'libopenblas-dev', 'ccache']
+
+    # what a worker needs to run what the master built into a shared prefix:
+    # the libraries it links against (as -dev packages, whose runtime
+    # package names change between releases) and the Python modules it
+    # imports, without the build toolchain
+    worker_apt_packages = ['libblas-dev', 'liblapack-dev', 'libopenblas-dev',
+                           'libcr-dev', 'libhdf5-serial-dev', 'libfftw3-dev',
+                           'libfftw3-mpi-dev', 'python-setuptools',
+                           'python-matplotlib', 'ipython', 'ipython-notebook',
+                           'python-pandas', 'python-sympy']
 
     easy_install_packages = ['mpi4py', 'h5py']
 
+    # (step name, method, steps it depends on, attributes it depends on);
+    # independent steps are run concurrently on each node by _doinstall
+    install_steps = [
+        ('apt', '_install_apt_packages', [], ['apt_packages']),
+        ('hdf5', '_fix_hdf5serial', ['apt'], []),
+        ('easy_install', '_install_easy_install_packages', ['apt', 'hdf5'],
+         ['easy_install_packages', 'install_prefix']),
+        ('boost', '_install_boost', ['apt'], ['boost_source', 'install_prefix']),
+        ('elemental', '_install_elemental', ['apt'], ['install_prefix']),
+        ('combblas', '_install_combblas', ['apt'],
+         ['combblas_source', 'combblas_patch', 'install_prefix']),
+        ('kdt', '_install_kdt', ['combblas'], ['kdt_source', 'install_prefix']),
+        ('fftw', '_install_fftw', ['apt'], ['fftw_source', 'install_prefix']),
+        ('random123', '_install_random123', [],
+         ['random123_source', 'install_prefix']),
+        ('spiral', '_install_spiral', ['apt'], ['spiral_source', 'install_prefix']),
+        ('bashrc', '_configure_bashrc', [], ['bashrc_settings']),
+        ('skylark', '_install_skylark', ['easy_install', 'boost', 'elemental',
+                                         'kdt', 'fftw', 'random123', 'spiral',
+                                         'bashrc'], ['find_fftw_patch']),
+    ]
+    # what each step leaves behind, checked on the node before the step is
+    # checkpointed as done; {prefix} is install_prefix
+    step_checks = {
+        'easy_install': ['python -c "import mpi4py, h5py"'],
+        'boost': ['test -f {prefix}/include/boost/version.hpp',
+                  'test -f {prefix}/lib/libboost_mpi.so'],
+        'elemental': ['test -f {prefix}/include/El.hpp'],
+        'combblas': ['test -f {prefix}/include/CombBLAS/CombBLAS.h'],
+        'kdt': ['python -c "import kdt"'],
+        'fftw': ['test -f {prefix}/include/fftw3.h',
+                 'test -f {prefix}/lib/libfftw3.so'],
+        'random123': ['test -f {prefix}/include/Random123/philox.h'],
+        'spiral': ['test -f {prefix}/lib/libwht.a'],
+        'skylark': ['test -d $SKYLARK_INSTALL_DIR/include/skylark'],
+    }
+    # with a shared prefix the workers only need the runtime libraries from
+    # apt (worker_apt_packages) and the profile; everything else is built
+    # once, on the master
+    worker_steps = ['apt', 'hdf5', 'bashrc']
+
     libinstall_directory = '/usr/local'
     python_local_dist_directory = "/usr/local/lib/python2.7/dist-packages"
 
@@ -71,53 +133,145 @@ class SkylarkInstaller(DefaultClusterSetup):
     spiral_directory = "spiral-wht-1.8"
     hadoop_source = "http://ftp.wayne.edu/apache/hadoop/common/hadoop-2.7.0/hadoop-2.7.0-src.tar.gz"
 
-    def __init__(self):
+    # max_parallel_steps caps how many install steps run at once on a node;
+    # by default it is half the node's cores since the builds are parallel
+    # themselves. apt_proxy routes every node's apt traffic through
+    # apt-cacher-ng on the master. trace_file, if given, is where the
+    # provisioning timeline is written. With ccache_dir set every compile goes
+    # through ccache with its cache, of at most ccache_size, in ccache_dir:
+    # /home is already NFS-shared by StarCluster, any other directory is
+    # exported from the master, so each translation unit is compiled once
+    # per cluster. With shared_prefix set the stack is built only on the
+    # master, installed under shared_prefix and NFS-mounted on the workers
+    def __init__(self, max_parallel_steps=None, apt_proxy=True, trace_file=None,
+                 ccache_dir=None, ccache_size='10G', shared_prefix=None):
         super(SkylarkInstaller, self).__init__()
         log.debug("Installing Skylark")
+        self._max_parallel_steps = max_parallel_steps and int(max_parallel_steps)
+        self._apt_proxy = clusterutils.as_bool(apt_proxy)
+        self._ccache_dir = ccache_dir
+        self._ccache_size = ccache_size
+        self._shared_prefix = shared_prefix
+        self._resources = {}
+        if trace_file:
+            tracing.enable(trace_file)
+
+    @property
+    def pool(self):
+        return tracing.TracedPool(super(SkylarkInstaller, self).pool)
+
+    def _node_resources(self, node):
+        if node.alias not in self._resources:
+            self._resources[node.alias] = nodeprobe.probe(node)
+        return self._resources[node.alias]
+
+    def _nproc(self, node):
+        # number of processors to use in making; the node's job budget is
+        # shared by the steps that may be building at the same time
+        return max(1, self._node_resources(node).build_jobs() // self._max_parallel(node))
+
+    @property
+    def install_prefix(self):
+        return self._shared_prefix or self.libinstall_directory
+
+    def _python_site(self):
+        return self.install_prefix + '/lib/python2.7/site-packages'
+
+    @property
+    def bashrc_settings(self):
+        settings = dict(self.bashrc_directories)
+        if self._shared_prefix:
+            prefix = self._shared_prefix
+            settings.update({
+                "SKYLARK_INSTALL_DIR": prefix,
+                "PYTHON_SITE_PACKAGES": self._python_site(),
+                "PYTHONPATH": self._python_site() + ":$PYTHONPATH",
+                "LD_LIBRARY_PATH": "/usr/local/hadoop/lib/native:" + prefix
+                + "/lib:/usr/lib/x86_64-linux-gnu:$LD_LIBRARY_PATH",
+                "PATH": prefix + "/bin:$PATH",
+                "CPATH": prefix + "/include",
+                "LIBRARY_PATH": prefix + "/lib",
+                "CMAKE_PREFIX_PATH": prefix,
+            })
+        return settings
+
+    def _build_env(self):
+        env = []
+        if self._shared_prefix:
+            # later steps find what earlier ones installed in the prefix
+            env += ['mkdir -p %s' % self._python_site()]
+            env += ['export %s="%s"' % item for item in sorted(self.bashrc_settings.items())
+                    if item[0] in ('PYTHONPATH', 'LD_LIBRARY_PATH', 'PATH', 'CPATH',
+                                   'LIBRARY_PATH', 'CMAKE_PREFIX_PATH')]
+        if self._ccache_dir:
+            # mpicc/mpicxx, cmake, configure and b2 all find gcc/g++ on the
+            # PATH, so the ccache symlinks catch every compile
+            env += ['export PATH=/usr/lib/ccache:$PATH',
+                    'export CCACHE_DIR=%s' % self._ccache_dir]
+        return env
+
+    def _python_install_options(self):
+        # left to Debian's default (/usr/local/.../dist-packages) otherwise
+        if self._shared_prefix:
+            return ' --prefix=%s' % self._shared_prefix
+        return ''
 
     def _follow_instructions(self, instructions, node):
-        node.ssh.execute(';'.join(instructions))
-
-    def _installedq(self, node):
-        return node.ssh.path_exists(self.SKYLARK_BASHRC)
+        # chained, so a step fails with the first command that does
+        node.ssh.execute(' && '.join(self._build_env() + instructions))
+
+    def _share_ccache(self, master, nodes):
+        if not self._ccache_dir:
+            return
+        clusterutils.share_dir(self.pool, master, nodes, self._ccache_dir)
+        fout = master.ssh.remote_file(posixpath.join(self._ccache_dir, 'ccache.conf'), 'w')
+        # umask keeps the cache writable from every node
+        fout.write('max_size = %s\numask = 002\n' % self._ccache_size)
+        fout.close()
+
+    # Expects the patch files to be in the same directory as this source file
+    def _patch_path(self, name):
+        return os.path.dirname(inspect.getsourcefile(SkylarkInstaller)) + '/' + name
+
+    def _read_patch(self, name):
+        with open(self._patch_path(name)) as fin:
+            return fin.read()
+
+    @property
+    def combblas_patch(self):
+        return self._read_patch('combblas.patch')
+
+    @property
+    def find_fftw_patch(self):
+        return self._read_patch('find_fftw.patch')
 
     def _configure_bashrc(self, node):
-        bashrc_addon = node.ssh.remote_file(self.SKYLARK_BASHRC, 'w')
-        for envvar, val in self.bashrc_directories.iteritems():
-            bashrc_addon.write("%s=%s\n" % (envvar, val))
-            bashrc_addon.write("export %s\n" % envvar)
-        # FIX: OVERWRITES
-        bashrc = node.ssh.remote_file('.bashrc', 'a')
-        bashrc.write('source ' + self.SKYLARK_BASHRC + '\n')
+        settings = []
+        for envvar, val in self.bashrc_settings.iteritems():
+            settings.append("%s=%s\n" % (envvar, val))
+            settings.append("export %s\n" % envvar)
+        bundle = configbundle.ConfigBundle()
+        bundle.add_file(self.SKYLARK_BASHRC, ''.join(settings))
+        bundle.append_line('/root/.bashrc', 'source ' + self.SKYLARK_BASHRC)
+        bundle.push(node)
 
     def _install_apt_packages(self, node):
         log.info("\tUpdating apt information")
         # node.apt_command('update')
         log.info("\tInstalling a bunch of apt packages")
-        for pkg in self.apt_packages:
-            log.info("\t...%s" % pkg)
-            node.apt_command('install %s' % pkg)
+        node.apt_command('install %s' % ' '.join(self.apt_packages))
         node.apt_command('clean') # free up space: the install process eats up a lot of disk space
 
+    def _install_worker_apt_packages(self, node):
+        log.info("\tInstalling the runtime libraries")
+        node.apt_command('install %s' % ' '.join(self.worker_apt_packages))
+        node.apt_command('clean')
+
     def _install_easy_install_packages(self, node):
         log.info('\tInstalling easy_install packages')
         for pkg in self.easy_install_packages:
             log.info("\t...%s" % pkg)
-            node.ssh.execute('easy_install %s' % pkg)
-
-# Autodetection of chipset seems to fail on EC2
-    def _install_openblas(self, node):
-        log.info("\tInstalling OpenBLAS")
-     #   instructions = [
-     #       'wget -O OpenBLAS.tgz %s' % self.openblas_source,
-     #       'tar xzvf OpenBLAS.tgz',
-     #       'cd %s' % self.openblas_directory,
-     #       'make -j4',
-     #       'make PREFIX=%s install' % self.libinstall_directory,
-     #       'cd ..'
-     #   ]
-     #   self._follow_instructions(instructions, node)
-        node.apt_command('install libopenblas-dev')
+            self._follow_instructions(['easy_install%s %s' % (self._python_install_options(), pkg)], node)
 
     def _install_boost(self, node):
         log.info("\tInstalling Boost")
@@ -126,10 +280,10 @@ class SkylarkInstaller(DefaultClusterSetup):
             'tar xvfz boost.tgz',
             'cd %s' % self.boost_directory,
             # seems like this script always returns false regardless of actual success?
-            './bootstrap.sh --with-libraries=mpi,python,random,serialization,program_options,system,filesystem',
+            '(./bootstrap.sh --with-libraries=mpi,python,random,serialization,program_options,system,filesystem || true)',
             'echo "using mpi ;" >> project-config.jam',
-            './b2 -j 6 link=static,shared',
-            './b2 install',
+            './b2 -j %d link=static,shared' % self._nproc(node),
+            './b2 install --prefix=%s' % self.install_prefix,
             'cd ..',
             'rm -rf boost.tgz %s' % self.boost_directory
         ]
@@ -138,14 +292,15 @@ class SkylarkInstaller(DefaultClusterSetup):
     def _install_elemental(self, node):
         log.info("\tInstalling Elemental")
         instructions = [
+            "rm -rf Elemental",
             "git clone https://github.com/elemental/Elemental.git Elemental",
             "cd Elemental",
             "git checkout 4a16736e44b24ced2d0dd9d3f688ce2d149611ba",
             "git clone https://github.com/poulson/metis.git external/metis",
             "mkdir build",
             "cd build",
-            'cmake -DEL_USE_64BIT_INTS=ON -DCMAKE_BUILD_TYPE=Release -DMATH_LIBS="-L/usr/lib:/usr/lib/lapack -llapack -lopenblas -lm" ..',
-            "make -j %s" % self.nproc,
+            'cmake -DEL_USE_64BIT_INTS=ON -DCMAKE_BUILD_TYPE=Release -DCMAKE_INSTALL_PREFIX=%s -DMATH_LIBS="-L/usr/lib:/usr/lib/lapack -llapack -lopenblas -lm" ..' % self.install_prefix,
+            "make -j %d" % self._nproc(node),
             "make install",
             "cd ../..",
             "rm -r Elemental"
@@ -161,8 +316,7 @@ class SkylarkInstaller(DefaultClusterSetup):
         ]
         self._follow_instructions(instructions, node)
 
-        # Expects the combblas.patch file to be in the same directory as this source file
-        patchfname = os.path.dirname(inspect.getsourcefile(SkylarkInstaller)) + '/combblas.patch'
+        patchfname = self._patch_path('combblas.patch')
         log.info(patchfname)
         node.ssh.put(patchfname, 'CombBLAS/combblas.patch')
 
@@ -171,14 +325,14 @@ class SkylarkInstaller(DefaultClusterSetup):
             "yes | git apply --ignore-space-change --ignore-whitespace combblas.patch",
             "rm combblas.patch",
             "cmake .",
-            "make -j %s" % self.nproc,
-            "cp *.so /usr/local/lib",
-            "mkdir /usr/local/include/CombBLAS",
-            "cp *.h /usr/local/include/CombBLAS",
-            "cp *.cpp /usr/local/include/CombBLAS",
-            "cp -R SequenceHeaps /usr/local/include/CombBLAS",
-            "cp -R psort-1.0 /usr/local/include/CombBLAS",
-            "cp -R graph500-1.2 /usr/local/include/CombBLAS",
+            "make -j %d" % self._nproc(node),
+            "mkdir -p {0}/lib {0}/include/CombBLAS".format(self.install_prefix),
+            "cp *.so %s/lib" % self.install_prefix,
+            "cp *.h %s/include/CombBLAS" % self.install_prefix,
+            "cp *.cpp %s/include/CombBLAS" % self.install_prefix,
+            "cp -R SequenceHeaps %s/include/CombBLAS" % self.install_prefix,
+            "cp -R psort-1.0 %s/include/CombBLAS" % self.install_prefix,
+            "cp -R graph500-1.2 %s/include/CombBLAS" % self.install_prefix,
             "cd ..",
             "rm -r CombBLAS"
         ]
@@ -193,7 +347,7 @@ class SkylarkInstaller(DefaultClusterSetup):
             "export CC=mpicxx",
             "export CXX=mpicxx",
             "python ./setup.py build",
-            "python ./setup.py install",
+            "python ./setup.py install%s" % self._python_install_options(),
             "cd ..",
             "rm -rf kdt.tgz %s" % self.kdt_directory
         ]
@@ -205,8 +359,8 @@ class SkylarkInstaller(DefaultClusterSetup):
             "wget -O fftw.tgz %s" % self.fftw_source,
             "tar xvfz fftw.tgz",
             "cd %s" % self.fftw_directory,
-            "./configure --enable-shared",
-            "make -j 6",
+            "./configure --enable-shared --prefix=%s" % self.install_prefix,
+            "make -j %d" % self._nproc(node),
             "make install",
             "cd ..",
             "rm -rf fftw.tgz %s" % self.fftw_directory
@@ -218,7 +372,8 @@ class SkylarkInstaller(DefaultClusterSetup):
         instructions = [
             "wget -O random123.tgz %s" % self.random123_source,
             "tar xvfz random123.tgz",
-            "cp -r %s /usr/local/include" % self.random123_includes,
+            "mkdir -p %s/include" % self.install_prefix,
+            "cp -r %s %s/include" % (self.random123_includes, self.install_prefix),
             "rm -rf random123.tgz %s" % self.random123_directory
         ]
         self._follow_instructions(instructions, node)
@@ -229,8 +384,8 @@ class SkylarkInstaller(DefaultClusterSetup):
             "wget -O spiral.tgz %s" % self.spiral_source,
             "tar xzvf spiral.tgz",
             "cd %s" % self.spiral_directory,
-            './configure CFLAGS="-fPIC -fopenmp" --enable-RAM=16000 --enable-DDL --enable-IL --enable-PARA=8',
-            "make -j %s" % self.nproc,
+            './configure CFLAGS="-fPIC -fopenmp" --enable-RAM=16000 --enable-DDL --enable-IL --enable-PARA=8 --prefix=%s' % self.install_prefix,
+            "make -j %d" % self._nproc(node),
             "make install",
             "cd ..",
             "rm -r spiral.tgz %s" % self.spiral_directory
@@ -240,23 +395,29 @@ class SkylarkInstaller(DefaultClusterSetup):
     def _install_skylark(self, node):
         log.info("\tInstalling Skylark")
 
-        # Expects the combblas.patch file to be in the same directory as this source file
-        patchfname = os.path.dirname(inspect.getsourcefile(SkylarkInstaller)) + '/find_fftw.patch'
-        node.ssh.put(patchfname, '/home/find_fftw.patch')
-
         instructions = [
             "mkdir -p $SKYLARK_BUILD_DIR",
             "mkdir -p $SKYLARK_INSTALL_DIR",
+            "rm -rf $SKYLARK_SRC_DIR",
             "yes | git clone https://github.com/xdata-skylark/libskylark.git $SKYLARK_SRC_DIR",
             "cd $SKYLARK_SRC_DIR",
-            "git checkout development",
-            "mv /home/find_fftw.patch .",
+            "git checkout development"
+        ]
+        self._follow_instructions(instructions, node)
+
+        # straight into the node's own checkout; /home is shared by every node
+        patchfname = self._patch_path('find_fftw.patch')
+        node.ssh.put(patchfname, posixpath.join(self.bashrc_settings['SKYLARK_SRC_DIR'],
+                                                'find_fftw.patch'))
+
+        instructions = [
+            "cd $SKYLARK_SRC_DIR",
             "yes | git apply --ignore-space-change --ignore-whitespace find_fftw.patch",
             "rm find_fftw.patch",
             "cd $SKYLARK_BUILD_DIR",
             "CC=mpicc CXX=mpicxx cmake -DCMAKE_INSTALL_PREFIX=$SKYLARK_INSTALL_DIR" +
             " -DUSE_COMBBLAS=ON $SKYLARK_SRC_DIR",
-            "make -j %s" % self.nproc,
+            "make -j %d" % self._nproc(node),
             "make install",
             "make doc"
         ]
@@ -272,30 +433,113 @@ class SkylarkInstaller(DefaultClusterSetup):
 
         # os.path.exists and os.path.isdir don't return True when the path exists! so use shell scripting
         instructions = [
-            'ln -s /usr/include/hdf5/serial/* /usr/include',
-            "if [ -d %s ]; then ln -s %s/* /usr/lib; else ln -s %s/* /usr/lib; fi" % (AMD_KERNEL_DIR, AMD_KERNEL_DIR, INTEL_KERNEL_DIR)
+            'ln -sf /usr/include/hdf5/serial/* /usr/include',
+            "if [ -d %s ]; then ln -sf %s/* /usr/lib; else ln -sf %s/* /usr/lib; fi" % (AMD_KERNEL_DIR, AMD_KERNEL_DIR, INTEL_KERNEL_DIR)
         ]
         self._follow_instructions(instructions, node)
 
-    def _doinstall(self, node):
-        if not self._installedq(node):
-            self._install_apt_packages(node)
-            self._fix_hdf5serial(node)
-            self._install_easy_install_packages(node)
-            self._install_openblas(node)
-            self._install_boost(node)
-            self._install_elemental(node)
-            self._install_combblas(node)
-            self._install_kdt(node)
-            self._install_fftw(node)
-            self._install_random123(node)
-            self._install_spiral(node)
-            self._configure_bashrc(node)
-            self._install_skylark(node)
+    def _step_inputs(self, method, attrs):
+        inputs = [inspect.getsource(getattr(self, method))]
+        for attr in attrs:
+            value = getattr(self, attr)
+            if isinstance(value, dict):
+                value = sorted(value.items())
+            inputs.append((attr, value))
+        return inputs
+
+    def _check_step(self, name, node):
+        checks = [c.format(prefix=self.install_prefix) for c in self.step_checks.get(name, [])]
+        if checks:
+            node.ssh.execute(' && '.join(self._build_env() + checks))
+
+    def _checked(self, name, method):
+        def step(node):
+            getattr(self, method)(node)
+            self._check_step(name, node)
+        return step
+
+    def _step_graph(self, worker=False):
+        steps = []
+        for name, method, deps, attrs in self.install_steps:
+            if worker and name not in self.worker_steps:
+                continue
+            if worker and name == 'apt':
+                method, attrs = '_install_worker_apt_packages', ['worker_apt_packages']
+            steps.append(stepgraph.Step(name, self._checked(name, method), deps,
+                                        self._step_inputs(method, attrs)))
+        return stepgraph.StepGraph(steps)
+
+    def _max_parallel(self, node):
+        if self._max_parallel_steps:
+            return self._max_parallel_steps
+        return max(1, self._node_resources(node).cores // 2)
+
+    def _stack_digest(self):
+        # every other step is a dependency of the skylark step, so its
+        # digest covers the whole install
+        return [s for s in self._step_graph().steps if s.name == 'skylark'][0].digest
+
+    def bake_image(self, node):
+        """Installs the Skylark stack on a single node that is being saved
+        as an image"""
+        self._doinstall(node, node)
+        versions = {
+            'boost': self.boost_directory,
+            'combblas': os.path.basename(self.combblas_source),
+            'kdt': self.kdt_directory,
+            'fftw': self.fftw_directory,
+            'random123': self.random123_directory,
+            'spiral': self.spiral_directory,
+        }
+        stackmanifest.record(node, 'skylark', self._stack_digest(), versions)
+
+    def _needs_apt(self, node, master):
+        # whether node's apt step has yet to run, so it needs the apt proxy
+        if stackmanifest.matches(node, 'skylark', self._stack_digest()):
+            return False
+        apt = [s for s in self._step_graph(self._is_worker(node, master)).steps
+               if s.name == 'apt'][0]
+        return not checkpoint.Checkpoints(node, 'skylark').is_done('apt', apt.digest)
+
+    def _doinstall(self, node, master, worker=False):
+        if stackmanifest.matches(node, 'skylark', self._stack_digest()):
+            log.info("Skylark is already in the image on %s" % node.alias)
+            return
+        if self._apt_proxy and self._needs_apt(node, master):
+            clusterutils.use_apt_proxy(node, master)
+        checkpoints = checkpoint.Checkpoints(node, 'skylark')
+        timings = self._step_graph(worker).run(node, self._max_parallel(node), checkpoints)
+        log.info(stepgraph.format_report(node.alias, timings))
+
+    def _is_worker(self, node, master):
+        # only runs worker_steps
+        return bool(self._shared_prefix) and node.alias != master.alias
  
 
+    @tracing.traced_hook
     def run(self, nodes, master, user, user_shell, volumes):
         log.info("Installing Skylark")
+        if self._apt_proxy and any(
+                clusterutils.map_nodes(self.pool, nodes, self._needs_apt, master).values()):
+            clusterutils.serve_apt_proxy(master)
+        self._share_ccache(master, nodes)
+        if self._shared_prefix:
+            clusterutils.share_dir(self.pool, master, nodes, self._shared_prefix)
         for node in nodes:
-            self.pool.simple_job(self._doinstall, (node), jobid=node.alias)
+            self.pool.simple_job(self._doinstall, (node, master, self._is_worker(node, master)),
+                                 jobid=node.alias)
         self.pool.wait(numtasks = len(nodes))
+
+    @tracing.traced_hook
+    def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Installing Skylark on %s" % node.alias)
+        if self._apt_proxy and self._needs_apt(node, master):
+            clusterutils.serve_apt_proxy(master)
+        self._share_ccache(master, [node])
+        if self._shared_prefix:
+            clusterutils.share_dir(self.pool, master, [node], self._shared_prefix)
+        self._doinstall(node, master, self._is_worker(node, master))
+
+    @tracing.traced_hook
+    def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Nothing to do for Skylark when removing %s" % node.alias)
@@ -1,93 +1,488 @@
 # Installs Spark
-# TODO: support adding and removing nodes 
-# TODO: check for if spark already installed: if so, just 
-# need to update the slaves file
-# CAVEAT: as is, Spark will be broken if you change the number
-# nodes without deleting spark and rerunning this setup plugin
+# Nodes added to or removed from a running cluster are handled incrementally
+# by on_add_node/on_remove_node: only the new node gets Spark installed, the
+# other nodes just have their conf/slaves file updated
 
 from starcluster import clustersetup
 from starcluster.logger import log
 
+import posixpath
+
+import checkpoint
+import clusterutils
+import configbundle
+import daemonlauncher
+import myhadoop
+import nodeprobe
+import stackmanifest
+import tracing
+
 class SparkInstaller(clustersetup.DefaultClusterSetup):
 
     spark_home = '/opt/Spark'
-    spark_source = 'http://mirror.metrocast.net/apache/spark/spark-1.3.1/spark-1.3.1.tgz'
-    spark_directory = 'spark-1.3.1'
+    spark_mirror = 'https://archive.apache.org/dist/spark'
     spark_profile = '/etc/profile.d/spark.sh'
+    spark_build_dir = '/tmp/spark-build'
+    spark_worker_class = 'org.apache.spark.deploy.worker.Worker'
+    maven_opts = '-Xmx2g -XX:MaxPermSize=512M -XX:ReservedCodeCacheSize=512m'
+    # Maven options for each Hadoop profile a distribution can be built
+    # against; Apache publishes prebuilt binaries for prebuilt_profiles only
+    hadoop_profiles = {
+        'hadoop2.4': '-Phadoop-2.4 -Dhadoop.version=2.4.0',
+        'hadoop2.6': '-Phadoop-2.4 -Dhadoop.version=2.6.0',
+        'hadoop-provided': '-Phadoop-provided -Phadoop-2.4 -Dhadoop.version=2.4.0',
+    }
+    prebuilt_profiles = ['hadoop2.4', 'hadoop2.6']
+    hadoop_home = '/usr/local/hadoop'
+    yarn_executor_cores = 4
 
-    def __init__(self, pythonpath = "", ldlibrarypath ="" ):
+    # build_mode is either 'master' (build one distribution tarball on the
+    # master and unpack it everywhere) or 'node' (build on every node).
+    # distribution is 'binary' (download Apache's prebuilt tarball for
+    # hadoop_profile), 'source' (build it) or 'auto', which downloads unless
+    # the profile has no prebuilt tarball or build_options asks for a custom
+    # build. checksum ('sha512:<hex>' etc.) pins the download; without it the
+    # checksum Apache publishes next to the tarball is used.
+    # cluster_manager is 'standalone' (Spark's own master and workers) or
+    # 'yarn', which submits to the Hadoop cluster HadoopInstaller set up with
+    # spark_shuffle=True and scales executors with dynamic allocation.
+    # trace_file, if given, is where the provisioning timeline is written
+    def __init__(self, pythonpath = "", ldlibrarypath ="", build_mode='master',
+                 trace_file=None, spark_version='1.3.1', hadoop_profile='hadoop2.4',
+                 distribution='auto', build_options=None, checksum=None,
+                 cluster_manager='standalone'):
         super(SparkInstaller, self).__init__()
         self._pythonpath = pythonpath
         self._ldlibrarypath = ldlibrarypath
+        if build_mode not in ('master', 'node'):
+            raise ValueError("build_mode must be 'master' or 'node', got %r" % build_mode)
+        self._build_mode = build_mode
+        if cluster_manager not in ('standalone', 'yarn'):
+            raise ValueError("cluster_manager must be 'standalone' or 'yarn', got %r"
+                             % cluster_manager)
+        self._cluster_manager = cluster_manager
+        if distribution not in ('auto', 'binary', 'source'):
+            raise ValueError("distribution must be 'auto', 'binary' or 'source', got %r"
+                             % distribution)
+        if not build_options and hadoop_profile not in self.hadoop_profiles:
+            raise ValueError("unknown hadoop_profile %r, set build_options to build it"
+                             % hadoop_profile)
+        prebuilt = hadoop_profile in self.prebuilt_profiles and not build_options
+        if distribution == 'binary' and not prebuilt:
+            raise ValueError("no prebuilt Spark for hadoop_profile %r with custom build_options"
+                             % hadoop_profile)
+        if distribution == 'auto':
+            distribution = 'binary' if prebuilt else 'source'
+        self._distribution = distribution
+        self.spark_version = spark_version
+        self.hadoop_profile = hadoop_profile
+        self._build_options = build_options
+        self._checksum = clusterutils.parse_checksum(checksum) if checksum else None
+        if trace_file:
+            tracing.enable(trace_file)
+
+    @property
+    def pool(self):
+        return tracing.TracedPool(super(SparkInstaller, self).pool)
+
+    @property
+    def spark_directory(self):
+        return 'spark-%s' % self.spark_version
+
+    @property
+    def spark_source(self):
+        return '%s/spark-%s/spark-%s.tgz' % (self.spark_mirror, self.spark_version,
+                                             self.spark_version)
+
+    @property
+    def spark_binary(self):
+        return '%s/spark-%s/spark-%s-bin-%s.tgz' % (self.spark_mirror, self.spark_version,
+                                                    self.spark_version, self.hadoop_profile)
+
+    @property
+    def spark_build_options(self):
+        if self._build_options:
+            return self._build_options
+        return self.hadoop_profiles[self.hadoop_profile] + ' -Pyarn -DskipTests'
+
+    @property
+    def spark_dist_name(self):
+        # make-distribution.sh names its tarball spark-<version>-bin-<name>.tgz;
+        # source builds carry their options' digest so they never pass for
+        # Apache's binary or for a build with other options
+        if self._distribution == 'binary':
+            return self.hadoop_profile
+        return '%s-%s' % (self.hadoop_profile,
+                          checkpoint.digest(self.spark_build_options)[:8])
+
+    @property
+    def spark_artifact(self):
+        return 'spark-%s-bin-%s.tgz' % (self.spark_version, self.spark_dist_name)
 
     def _isinstalledq(self, node):
         return node.ssh.path_exists(self.spark_home)
 
-    def _build_spark(self, node):
+    def _maven_key(self):
+        return 'spark-' + checkpoint.digest(self.spark_source, self.spark_build_options)[:12]
+
+    def _maven_args(self, node):
+        return clusterutils.maven_args(node, self._maven_key(),
+                                       nodeprobe.probe(node).build_jobs())
+
+    def _download(self, master, url, name):
+        checksum = self._checksum or clusterutils.published_checksum(master, url)
+        log.info("...fetching %s (%s %s)" % (url, checksum[0], checksum[1][:16]))
+        clusterutils.cached_download(master, url, name, checksum)
+
+    def _fetch_spark_source(self, master):
+        self._download(master, self.spark_source, posixpath.basename(self.spark_source))
+
+    def _build_spark(self, node, master):
         if not self._isinstalledq(node):
             log.info("...building on %s" % node.alias)
+            clusterutils.fetch_artifact(node, master, posixpath.basename(self.spark_source),
+                                        'spark.tgz')
             instructions = [
-                "wget -O spark.tgz %s" % self.spark_source,
                 "tar xvf spark.tgz",
                 "rm spark.tgz",
                 "mv %s %s" % (self.spark_directory, self.spark_home),
                 "cd %s" % self.spark_home,
-                'export MAVEN_OPTS="-Xmx2g -XX:MaxPermSize=512M -XX:ReservedCodeCacheSize=512m"',
-                "build/mvn -Phadoop-provided -Phadoop-2.4 -Pyarn -Dhadoop.version=2.4.0 -DskipTests clean package 2>&1 "
+                'export MAVEN_OPTS="%s"' % self.maven_opts,
+                "build/mvn %s %s clean package 2>&1 " % (self._maven_args(node),
+                                                         self.spark_build_options)
             ]
             node.ssh.execute(' && '.join(instructions))
+            clusterutils.mark_maven_seeded(node, self._maven_key())
             log.info("...done building on %s" % node.alias)
 
+    def _build_spark_artifact(self, master):
+        artifact = clusterutils.artifact_path(self.spark_artifact)
+        if master.ssh.isfile(artifact):
+            log.info("...reusing %s on %s" % (artifact, master.alias))
+            return
+        if self._distribution == 'binary':
+            self._download(master, self.spark_binary, self.spark_artifact)
+            return
+        self._fetch_spark_source(master)
+        log.info("...building Spark distribution on %s" % master.alias)
+        instructions = [
+            "rm -rf %s" % self.spark_build_dir,
+            "mkdir -p %s" % self.spark_build_dir,
+            "cd %s" % self.spark_build_dir,
+            "tar xf %s" % clusterutils.artifact_path(posixpath.basename(self.spark_source)),
+            "cd %s" % self.spark_directory,
+            'export MAVEN_OPTS="%s"' % self.maven_opts,
+            "./make-distribution.sh --name %s --tgz %s %s 2>&1 " % (self.spark_dist_name,
+                                                                   self._maven_args(master),
+                                                                   self.spark_build_options),
+            "mv spark-*-bin-%s.tgz %s" % (self.spark_dist_name, artifact),
+            "cd /",
+            "rm -rf %s" % self.spark_build_dir
+        ]
+        master.ssh.execute(' && '.join(instructions))
+        clusterutils.mark_maven_seeded(master, self._maven_key())
+        log.info("...done building %s" % artifact)
+
+    def _install_spark_artifact(self, node, master):
+        if self._isinstalledq(node):
+            return
+        log.info("...unpacking Spark on %s" % node.alias)
+        staging = self.spark_home + '.partial'
+        clusterutils.fetch_artifact(node, master, self.spark_artifact, '/tmp/spark.tgz')
+        instructions = [
+            "rm -rf %s" % staging,
+            "mkdir -p %s" % staging,
+            "tar xzf /tmp/spark.tgz -C %s --strip-components=1" % staging,
+            "mv %s %s" % (staging, self.spark_home),
+            "rm /tmp/spark.tgz"
+        ]
+        node.ssh.execute(' && '.join(instructions))
+
+    def _setup_slaves(self, bundle, aliases):
+        bundle.add_file("%s/conf/slaves" % self.spark_home, '\n'.join(aliases) + '\n')
+
+    def _setup_profile(self, bundle):
+        profile_settings = [
+            "export SPARK_HOME=%s" % self.spark_home,
+            "export PATH=$PATH:$SPARK_HOME/bin"
+        ]
+        bundle.add_file(self.spark_profile, '\n'.join(profile_settings))
+
+    def _setup_spark_env(self, bundle, resources, is_master):
+        instances = resources.worker_instances()
+        local_dirs = resources.local_dirs('spark')
+        # the workers' executors get what is left after the heaps of the
+        # worker JVMs and of the DataNode and NodeManager beside them, and on
+        # the master of the Spark master, NameNode and ResourceManager too
+        daemons = instances + 2 + (3 if is_master else 0)
+        worker_mb = resources.usable_memory_mb(myhadoop.DAEMON_HEAP_MB * daemons) // instances
+        sparkenv_settings = [
+            "#!/usr/bin/env bash",
+            "export PYTHONPATH=$PYTHONPATH:{0}".format(self._pythonpath),
+            "export LD_LIBRARY_PATH={0}".format(self._ldlibrarypath),
+            "export SPARK_WORKER_INSTANCES={0}".format(instances),
+            "export SPARK_WORKER_CORES={0}".format(resources.usable_cores() // instances),
+            "export SPARK_WORKER_MEMORY={0}m".format(worker_mb),
+            "export SPARK_LOCAL_DIRS={0}".format(','.join(local_dirs))
+        ]
+        if self._cluster_manager == 'yarn':
+            sparkenv_settings += [
+                "export HADOOP_CONF_DIR={0}/etc/hadoop".format(self.hadoop_home),
+                "export YARN_CONF_DIR={0}/etc/hadoop".format(self.hadoop_home)
+            ]
+        bundle.add_file("%s/conf/spark-env.sh" % self.spark_home, '\n'.join(sparkenv_settings))
+        # shuffle and spill files go to every local data volume; sticky and
+        # world-writable like /tmp, since jobs may run as any cluster user
+        bundle.add_command("mkdir -p %s" % ' '.join(local_dirs))
+        bundle.add_command("chmod 1777 %s" % ' '.join(local_dirs))
+
+    def _setup_scripts(self, bundle, master):
+        # workers are started on every node of conf/slaves at once, each
+        # with as many instances as its own spark-env.sh asks for
+        start_master = daemonlauncher.Daemon(
+            'spark-master', 7077, "cd %s && ./sbin/start-master.sh" % self.spark_home)
+        start_workers = daemonlauncher.Daemon(
+            'spark-worker', 8081,
+            "cd %s && . conf/spark-env.sh && "
+            "for i in $(seq 1 ${SPARK_WORKER_INSTANCES:-1}); do "
+            "./sbin/spark-daemon.sh start %s $i --webui-port $((8080 + i)) spark://%s:7077; done"
+            % (self.spark_home, self.spark_worker_class, master.alias))
+        startspark = daemonlauncher.script('Spark', [
+            ([master.alias], [start_master]),
+            ("%s/conf/slaves" % self.spark_home, [start_workers])])
+        bundle.add_file("/home/startspark.sh", startspark, 0755)
+
+        # and stopped the same way, the workers before the master
+        stop_workers = daemonlauncher.Daemon(
+            'spark-worker', None,
+            "cd %s && . conf/spark-env.sh && "
+            "for i in $(seq 1 ${SPARK_WORKER_INSTANCES:-1}); do "
+            "./sbin/spark-daemon.sh stop %s $i; done"
+            % (self.spark_home, self.spark_worker_class))
+        stop_master = daemonlauncher.Daemon(
+            'spark-master', None, "cd %s && ./sbin/stop-master.sh" % self.spark_home)
+        stopspark = daemonlauncher.stop_script('Spark', [
+            ("%s/conf/slaves" % self.spark_home, [stop_workers]),
+            ([master.alias], [stop_master])])
+        bundle.add_file("/home/stopspark.sh", stopspark, 0755)
+
+    def _executor_size(self, resources, is_master):
+        # (cores, memory MB) of an executor whose container, its memory plus
+        # the max(384MB, 7%) overhead rounded up to YARN's allocation
+        # increment, takes its share of the node's NodeManager memory
+        cores = min(self.yarn_executor_cores, resources.usable_cores())
+        share_mb = (myhadoop.nodemanager_memory_mb(resources, is_master) * cores
+                    // resources.usable_cores())
+        increment = myhadoop.MIN_ALLOCATION_MB
+        container_mb = max(increment, share_mb // increment * increment)
+        return cores, int(min(container_mb - 384, container_mb / 1.07))
+
+    def _shuffle_serviceq(self, master):
+        # HadoopInstaller only registers spark_shuffle with spark_shuffle=True
+        yarn_site = "%s/etc/hadoop/yarn-site.xml" % self.hadoop_home
+        master.ssh.execute("grep -q spark_shuffle %s" % yarn_site, ignore_exit_status=True)
+        return master.ssh.get_last_status() == 0
+
+    def _yarn_defaults(self, resources, master, shuffle_service=True):
+        """
+        spark-defaults.conf for YARN, given every node's NodeResources by
+        alias; without the NodeManagers' shuffle service, executors can't
+        come and go, so each job gets a fixed set
+        """
+        sizes = [self._executor_size(r, alias == master.alias)
+                 for alias, r in resources.items()]
+        cores = min(c for c, mb in sizes)
+        memory_mb = min(mb for c, mb in sizes)
+        max_executors = sum(r.usable_cores() // cores for r in resources.values())
+        settings = [
+            "spark.master yarn-client",
+            "spark.executor.cores %d" % cores,
+            "spark.executor.memory %dm" % memory_mb
+        ]
+        if shuffle_service:
+            # executors come and go with the load and leave their shuffle
+            # files with the NodeManagers' spark_shuffle service
+            settings += [
+                "spark.dynamicAllocation.enabled true",
+                "spark.dynamicAllocation.minExecutors 0",
+                "spark.dynamicAllocation.maxExecutors %d" % max_executors,
+                "spark.dynamicAllocation.executorIdleTimeout 60",
+                "spark.shuffle.service.enabled true"
+            ]
+        else:
+            settings.append("spark.executor.instances %d" % max_executors)
+        return '\n'.join(settings) + '\n'
+
+    def _setup_yarn(self, bundle, defaults):
+        bundle.add_file("%s/conf/spark-defaults.conf" % self.spark_home, defaults)
+        # the NodeManagers load the spark_shuffle service from this jar
+        bundle.add_command("cp %s/lib/spark-*-yarn-shuffle.jar %s/share/hadoop/yarn/lib/"
+                           % (self.spark_home, self.hadoop_home))
+
+    def _configure_node(self, node, master, aliases, resources, yarn_defaults=None):
+        bundle = configbundle.ConfigBundle()
+        self._setup_profile(bundle)
+        self._setup_spark_env(bundle, resources, node.alias == master.alias)
+        if self._cluster_manager == 'yarn':
+            self._setup_yarn(bundle, yarn_defaults)
+        else:
+            self._setup_slaves(bundle, aliases)
+            if node.alias == master.alias:
+                self._setup_scripts(bundle, master)
+        bundle.push(node)
+
+    def _stack_digest(self):
+        return checkpoint.digest(self.spark_artifact, self.spark_home)
+
+    def bake_image(self, node):
+        """Installs Spark on a single node that is being saved as an image"""
+        self._build_spark_artifact(node)
+        self._install_spark_artifact(node, node)
+        # the image has no use for Spark's tarballs; the rest of the artifact
+        # root holds the Hadoop apt repo the hadoop-packages checkpoints
+        # vouch for, so it stays
+        tarballs = [clusterutils.artifact_path(name) for name in
+                    (self.spark_artifact, posixpath.basename(self.spark_source))]
+        node.ssh.execute(' '.join(['rm -f'] + ['$(readlink -f %s) %s' % (t, t)
+                                               for t in tarballs]))
+        stackmanifest.record(node, 'spark', self._stack_digest(),
+                             {'spark': self.spark_directory,
+                              'hadoop_profile': self.hadoop_profile,
+                              'distribution': self._distribution})
+
+    def _install_node(self, node, master):
+        if stackmanifest.matches(node, 'spark', self._stack_digest()):
+            log.info("...Spark is already in the image on %s" % node.alias)
+            return
+        if self._distribution == 'binary' or self._build_mode == 'master':
+            self._build_spark_artifact(master)
+            clusterutils.serve_artifacts(master)
+            self._install_spark_artifact(node, master)
+        else:
+            self._fetch_spark_source(master)
+            clusterutils.serve_artifacts(master)
+            clusterutils.share_dir(self.pool, master, [node], clusterutils.MAVEN_REPO)
+            self._build_spark(node, master)
+
+    def _yarn_runningq(self, master):
+        return clusterutils.process_running(master, 'resourcemanager[.]ResourceManager')
+
+    def _restart_nodemanager(self, node, user):
+        # HadoopInstaller may have started the NodeManager before the shuffle
+        # jar was in place, in which case it failed to load spark_shuffle
+        node.ssh.execute('su -l %s -c "source /home/%s/sethadoopenv.sh; '
+                         '\\$HADOOP_HOME/sbin/yarn-daemon.sh stop nodemanager; '
+                         '\\$HADOOP_HOME/sbin/yarn-daemon.sh start nodemanager"' % (user, user))
+
+    def _master_runningq(self, master):
+        return clusterutils.process_running(master, 'deploy[.]master[.]Master')
+
+    def _start_worker(self, node, master, resources):
+        # same numbering and web UI ports as sbin/start-slaves.sh
+        for i in range(1, resources.worker_instances() + 1):
+            node.ssh.execute("cd %s && ./sbin/spark-daemon.sh start %s %d --webui-port %d spark://%s:7077"
+                             % (self.spark_home, self.spark_worker_class, i, 8080 + i, master.alias))
+
+    def _stop_worker(self, node, resources):
+        for i in range(1, resources.worker_instances() + 1):
+            node.ssh.execute("cd %s && ./sbin/spark-daemon.sh stop %s %d"
+                             % (self.spark_home, self.spark_worker_class, i),
+                             ignore_exit_status=True)
+
+    @tracing.traced_hook
     def run(self, nodes, master, user, shell, volumes):
         log.info("Installing Spark")
 
         aliases = [n.alias for n in nodes]
 
+        baked = stackmanifest.matching(self.pool, nodes, 'spark', self._stack_digest())
+        if baked:
+            log.info("...Spark is already in the image on %d of %d nodes"
+                     % (len(baked), len(nodes)))
+        todo = [n for n in nodes if n.alias not in baked]
+        if todo and (self._distribution == 'binary' or self._build_mode == 'master'):
+            self._build_spark_artifact(master)
+            clusterutils.serve_artifacts(master)
+            for node in todo:
+                self.pool.simple_job(self._install_spark_artifact, (node, master), jobid=node.alias)
+        elif todo:
+            # every node builds against the master's Maven repository; the
+            # master's own build seeds it so the others can run offline
+            self._fetch_spark_source(master)
+            clusterutils.serve_artifacts(master)
+            clusterutils.share_dir(self.pool, master, nodes, clusterutils.MAVEN_REPO)
+            if master.alias in [n.alias for n in todo]:
+                self._build_spark(master, master)
+                todo = [n for n in todo if n.alias != master.alias]
+            for node in todo:
+                self.pool.simple_job(self._build_spark, (node, master), jobid=node.alias)
+        self.pool.wait(numtasks=len(todo))
+
+        log.info("...sizing workers to each node's hardware")
+        resources = nodeprobe.probe_all(self.pool, nodes, nodeprobe.volume_mounts(volumes))
+
+        yarn_defaults = None
+        shuffle_service = False
+        if self._cluster_manager == 'yarn':
+            shuffle_service = self._shuffle_serviceq(master)
+            if not shuffle_service:
+                log.warn("YARN has no spark_shuffle service (run HadoopInstaller "
+                         "with spark_shuffle = True), so dynamic allocation "
+                         "stays off")
+            yarn_defaults = self._yarn_defaults(resources, master, shuffle_service)
+
+        log.info("...writing configuration to all nodes")
         for node in nodes:
-            self.pool.simple_job(self._build_spark, (node), jobid=node.alias)
+            self.pool.simple_job(self._configure_node,
+                                 (node, master, aliases, resources[node.alias], yarn_defaults),
+                                 jobid=node.alias)
         self.pool.wait(numtasks=len(nodes))
 
-        log.info("...writing conf/slaves file to all nodes")
-        for node in nodes:
-            slaves_conf = node.ssh.remote_file("%s/conf/slaves" % self.spark_home, 'w')
-            slaves_conf.write('\n'.join(aliases) + '\n')
-            slaves_conf.close()
-            slaves_profile = node.ssh.remote_file("%s" % self.spark_profile, 'w')
-            profile_settings = [
-                "export SPARK_HOME=%s" % self.spark_home,
-                "export PATH=$PATH:$SPARK_HOME/bin"
-            ]
-            slaves_profile.write('\n'.join(profile_settings))
-            slaves_profile.close()
+        if shuffle_service and self._yarn_runningq(master):
+            log.info("...restarting the NodeManagers for spark_shuffle")
+            clusterutils.map_nodes(self.pool, nodes, self._restart_nodemanager, user)
 
-        log.info("...writing spark-env script to all nodes")
-        for node in nodes:
-            sparkenv_conf = node.ssh.remote_file("%s/conf/spark-env.sh" % self.spark_home, 'w')
-            sparkenv_settings = [
-                "#!/usr/bin/env bash",
-                "export PYTHONPATH=$PYTHONPATH:{0}".format(self._pythonpath),
-                "export LD_LIBRARY_PATH={0}".format(self._ldlibrarypath)
-            ]
-            sparkenv_conf.write('\n'.join(sparkenv_settings))
+    @tracing.traced_hook
+    def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Adding %s to Spark" % node.alias)
+        aliases = [n.alias for n in nodes]
+        if node.alias not in aliases:
+            aliases.append(node.alias)
+        self._install_node(node, master)
+        resources = nodeprobe.probe(node, nodeprobe.volume_mounts(volumes))
+        if self._cluster_manager == 'yarn':
+            # jobs are submitted with the master's defaults, so the new node
+            # just gets a copy of them
+            defaults = master.ssh.execute("cat %s/conf/spark-defaults.conf" % self.spark_home)
+            self._configure_node(node, master, aliases, resources, '\n'.join(defaults) + '\n')
+            if self._shuffle_serviceq(master) and self._yarn_runningq(master):
+                log.info("...restarting the NodeManager on %s for spark_shuffle"
+                         % node.alias)
+                self._restart_nodemanager(node, user)
+            return
+        self._configure_node(node, master, aliases, resources)
 
-        log.info("...writing start/stopspark scripts to /home")
-        startspark = [
-            "#!/usr/bin/env bash",
-            "MASTER=%s" % master.alias,
-            'ssh $MASTER "(cd %s; ./sbin/start-master.sh)"' % self.spark_home,
-            'ssh $MASTER "(cd %s; ./sbin/start-slaves.sh)"' % self.spark_home
-        ]
-        startspark_file = master.ssh.remote_file("/home/startspark.sh", "w")
-        startspark_file.write("\n".join(startspark))
-        startspark_file.close()
+        others = [n for n in nodes if n.alias != node.alias]
+        for other in others:
+            self.pool.simple_job(clusterutils.add_line,
+                                 (other, "%s/conf/slaves" % self.spark_home, node.alias),
+                                 jobid=other.alias)
+        self.pool.wait(numtasks=len(others))
 
-        stopspark = [
-            "#!/usr/bin/env bash",
-            "MASTER=%s" % master.alias,
-            'ssh $MASTER "(cd %s; ./sbin/stop-slaves.sh)"' % self.spark_home,
-            'ssh $MASTER "(cd %s; ./sbin/stop-master.sh)"' % self.spark_home
-        ]
-        stopspark_file = master.ssh.remote_file("/home/stopspark.sh", "w")
-        stopspark_file.write("\n".join(stopspark))
-        stopspark_file.close()
+        if self._master_runningq(master):
+            log.info("...starting Spark worker on %s" % node.alias)
+            self._start_worker(node, master, resources)
 
+    @tracing.traced_hook
+    def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        log.info("Removing %s from Spark" % node.alias)
+        if self._cluster_manager == 'yarn':
+            # YARN reassigns the node's executors itself
+            return
+        self._stop_worker(node, nodeprobe.probe(node))
+        others = [n for n in nodes if n.alias != node.alias]
+        for other in others:
+            self.pool.simple_job(clusterutils.remove_line,
+                                 (other, "%s/conf/slaves" % self.spark_home, node.alias),
+                                 jobid=other.alias)
+        self.pool.wait(numtasks=len(others))
@@ -0,0 +1,41 @@
+import json
+import posixpath
+
+import clusterutils
+
+# An image built with `scimage_13.04.py --with-stack` already has Hadoop,
+# Spark and Skylark installed and says so in MANIFEST_PATH: one entry per
+# plugin holding the digest of everything that plugin's install depends on.
+# A plugin whose own digest matches the entry on a node skips the install
+# there and goes straight to configuration
+
+MANIFEST_PATH = '/etc/starcluster/stack-manifest.json'
+
+
+def read(node):
+    out = node.ssh.execute('cat %s 2>/dev/null || true' % MANIFEST_PATH)
+    try:
+        return json.loads('\n'.join(out))
+    except ValueError:
+        return {}
+
+
+def matches(node, component, digest):
+    entry = read(node).get(component)
+    return entry is not None and entry.get('digest') == digest
+
+
+def matching(pool, nodes, component, digest):
+    """Returns the aliases of the nodes whose image already has component"""
+    found = clusterutils.map_nodes(pool, nodes, matches, component, digest)
+    return set(alias for alias, baked in found.items() if baked)
+
+
+def record(node, component, digest, versions):
+    """Adds or replaces component's entry in node's manifest"""
+    manifest = read(node)
+    manifest[component] = {'digest': digest, 'versions': versions}
+    node.ssh.execute('mkdir -p %s' % posixpath.dirname(MANIFEST_PATH))
+    fout = node.ssh.remote_file(MANIFEST_PATH, 'w')
+    fout.write(json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+    fout.close()
@@ -0,0 +1,160 @@
+from starcluster.logger import log
+
+import threading
+import time
+
+import checkpoint
+import tracing
+
+# Runs the install steps for a single node as a dependency graph: a step
+# starts as soon as everything it depends on has finished, with at most
+# max_parallel steps in flight at once. With checkpoints, steps whose inputs
+# (and whose dependencies' inputs) are unchanged since they last succeeded
+# on the node are skipped
+
+
+class Step(object):
+    def __init__(self, name, func, deps=(), inputs=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.inputs = tuple(inputs)
+        self.digest = None
+
+
+class StepTiming(object):
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+class StepGraph(object):
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self._by_name = dict((s.name, s) for s in self.steps)
+        if len(self._by_name) != len(self.steps):
+            raise Exception("duplicate step names in %s" %
+                            [s.name for s in self.steps])
+        for step in self.steps:
+            for dep in step.deps:
+                if dep not in self._by_name:
+                    raise Exception("step %s depends on unknown step %s" %
+                                    (step.name, dep))
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        # also chains each step's digest onto its dependencies' digests, so
+        # a changed step invalidates everything built on top of it
+        done = set()
+        remaining = list(self.steps)
+        while remaining:
+            ready = [s for s in remaining if set(s.deps) <= done]
+            if not ready:
+                raise Exception("dependency cycle among steps %s" %
+                                [s.name for s in remaining])
+            for step in ready:
+                step.digest = checkpoint.digest(
+                    step.name, step.inputs,
+                    [self._by_name[dep].digest for dep in step.deps])
+                done.add(step.name)
+                remaining.remove(step)
+
+    def run(self, node, max_parallel=1, checkpoints=None):
+        """
+        Runs every step's func(node) respecting dependencies and returns a
+        list of StepTiming in completion order. If a step fails, no new
+        steps are started and the first failure is re-raised once the
+        running ones have finished.
+        """
+        max_parallel = max(1, int(max_parallel))
+        cond = threading.Condition()
+        pending = list(self.steps)
+        running = set()
+        done = set()
+        failures = []
+        timings = []
+
+        # a step is only skipped once everything it depends on is too
+        skipped = checkpoints is not None
+        while skipped:
+            skipped = [s for s in pending if set(s.deps) <= done and
+                       checkpoints.is_done(s.name, s.digest)]
+            for step in skipped:
+                log.info("...%s already done on %s" % (step.name, node.alias))
+                pending.remove(step)
+                done.add(step.name)
+
+        def worker(step):
+            start = time.time()
+            error = None
+            try:
+                with tracing.span(node.alias, step.name, 'step'):
+                    step.func(node)
+                if checkpoints is not None:
+                    checkpoints.mark_done(step.name, step.digest)
+            except Exception as e:
+                error = e
+            end = time.time()
+            cond.acquire()
+            try:
+                running.discard(step.name)
+                timings.append(StepTiming(step.name, start, end))
+                if error is None:
+                    done.add(step.name)
+                else:
+                    log.error("step %s failed on %s: %s" %
+                              (step.name, node.alias, error))
+                    failures.append(error)
+                cond.notify_all()
+            finally:
+                cond.release()
+
+        cond.acquire()
+        try:
+            while True:
+                if not failures:
+                    ready = [s for s in pending if set(s.deps) <= done]
+                    for step in ready[:max_parallel - len(running)]:
+                        pending.remove(step)
+                        running.add(step.name)
+                        thread = threading.Thread(target=worker, args=(step,),
+                                                  name='%s-%s' % (node.alias, step.name))
+                        thread.daemon = True
+                        thread.start()
+                if not running and (failures or not pending):
+                    break
+                cond.wait()
+        finally:
+            cond.release()
+        if failures:
+            raise failures[0]
+        return timings
+
+
+def format_report(alias, timings):
+    """
+    Describes when each step ran relative to the first one and which other
+    steps it overlapped with
+    """
+    if not timings:
+        return "%s: no steps ran" % alias
+    origin = min(t.start for t in timings)
+    finish = max(t.end for t in timings)
+    serial = sum(t.duration for t in timings)
+    lines = ["%s: %d steps in %.1fs (%.1fs if run one after another)" %
+             (alias, len(timings), finish - origin, serial)]
+    for timing in sorted(timings, key=lambda t: t.start):
+        alongside = [t.name for t in timings
+                     if t is not timing and t.overlaps(timing)]
+        lines.append("  %-12s %8.1fs -> %8.1fs  alongside: %s" %
+                     (timing.name, timing.start - origin, timing.end - origin,
+                      ', '.join(alongside) or '-'))
+    return '\n'.join(lines)
@@ -0,0 +1,225 @@
+from starcluster.logger import log
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Provisioning timeline shared by all the setup plugins. Once a plugin is
+# given a trace_file, every pool job, install step and remote command (SSH
+# execute, put, get and remote_file) is recorded with its node, start, end,
+# exit status and bytes moved, and the timeline is written out as Chrome
+# trace-event JSON (load it in chrome://tracing or ui.perfetto.dev) after
+# each plugin hook. Every node gets its own row, with one track per thread.
+
+
+class Tracer(object):
+    def __init__(self):
+        self.enabled = False
+        self.trace_file = None
+        self._lock = threading.Lock()
+        self._events = []
+        self._pids = {}
+        self._tids = {}
+
+    def enable(self, trace_file):
+        self.enabled = True
+        self.trace_file = trace_file
+
+    def reset(self):
+        with self._lock:
+            self._events = []
+            self._pids = {}
+            self._tids = {}
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def _ids(self, alias):
+        thread = threading.current_thread().ident
+        with self._lock:
+            pid = self._pids.setdefault(alias, len(self._pids) + 1)
+            tid = self._tids.setdefault(thread, len(self._tids) + 1)
+        return pid, tid
+
+    def record(self, alias, name, cat, start, end, status='ok', **args):
+        if not self.enabled:
+            return
+        pid, tid = self._ids(alias)
+        args['status'] = status
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                 'args': args}
+        with self._lock:
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, alias, name, cat, **args):
+        """
+        Records the enclosed block; the yielded dict can be filled in with
+        extra arguments such as bytes or exit_status
+        """
+        start = time.time()
+        status = 'ok'
+        try:
+            yield args
+        except Exception as e:
+            status = 'error: %s' % e
+            raise
+        finally:
+            self.record(alias, name, cat, start, time.time(), status, **args)
+
+    def chrome_trace(self):
+        events = self.events()
+        with self._lock:
+            pids = dict(self._pids)
+        meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                 'args': {'name': alias}} for alias, pid in pids.items()]
+        return {'traceEvents': meta + events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path=None):
+        path = path or self.trace_file
+        if not self.enabled or not path:
+            return
+        with open(os.path.expanduser(path), 'w') as fout:
+            json.dump(self.chrome_trace(), fout)
+        log.info("Wrote provisioning trace to %s" % path)
+
+
+TRACER = Tracer()
+
+
+def enable(trace_file):
+    TRACER.enable(trace_file)
+
+
+def span(alias, name, cat='step', **args):
+    return TRACER.span(alias, name, cat, **args)
+
+
+class _TracedFile(object):
+    def __init__(self, fileobj, alias, path, mode):
+        self._file = fileobj
+        self._alias = alias
+        self._path = path
+        self._mode = mode
+        self._start = time.time()
+        self._bytes = 0
+
+    def write(self, data):
+        self._bytes += len(data)
+        return self._file.write(data)
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        self._bytes += len(data)
+        return data
+
+    def __iter__(self):
+        for line in self._file:
+            self._bytes += len(line)
+            yield line
+
+    def close(self):
+        try:
+            return self._file.close()
+        finally:
+            TRACER.record(self._alias, 'remote_file %s' % self._path, 'sftp',
+                          self._start, time.time(), mode=self._mode,
+                          bytes=self._bytes)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def instrument(node):
+    """Wraps the remote operations of node's SSH client, once per client"""
+    if not TRACER.enabled:
+        return
+    ssh = node.ssh
+    if getattr(ssh, '_starcluster_traced', False):
+        return
+    alias = node.alias
+    execute, put, get, remote_file = ssh.execute, ssh.put, ssh.get, ssh.remote_file
+
+    def traced_execute(command, *args, **kwargs):
+        with TRACER.span(alias, command.strip().split('\n')[0][:80], 'ssh',
+                         command=command) as info:
+            out = execute(command, *args, **kwargs)
+            info['exit_status'] = ssh.get_last_status()
+            info['bytes'] = len(command) + sum(len(line) for line in out or [])
+            return out
+
+    def traced_put(localpaths, remotepath='.'):
+        with TRACER.span(alias, 'put %s' % remotepath, 'sftp') as info:
+            paths = localpaths if isinstance(localpaths, list) else [localpaths]
+            info['bytes'] = sum(os.path.getsize(p) for p in paths
+                                if os.path.isfile(p))
+            return put(localpaths, remotepath)
+
+    def traced_get(remotepaths, localpath=''):
+        with TRACER.span(alias, 'get %s' % remotepaths, 'sftp') as info:
+            result = get(remotepaths, localpath)
+            if localpath and os.path.isfile(localpath):
+                info['bytes'] = os.path.getsize(localpath)
+            return result
+
+    def traced_remote_file(path, mode='w'):
+        return _TracedFile(remote_file(path, mode), alias, path, mode)
+
+    ssh.execute = traced_execute
+    ssh.put = traced_put
+    ssh.get = traced_get
+    ssh.remote_file = traced_remote_file
+    ssh._starcluster_traced = True
+
+
+class TracedPool(object):
+    """Thread pool wrapper recording every simple_job as a span"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def simple_job(self, method, args=[], kwargs={}, jobid=None, **kw):
+        if not TRACER.enabled:
+            return self._pool.simple_job(method, args, kwargs, jobid=jobid, **kw)
+        if not isinstance(args, (list, tuple)):
+            args = (args,)
+        for arg in args:
+            if hasattr(arg, 'ssh'):
+                instrument(arg)
+        name = getattr(method, '__name__', str(method)).lstrip('_')
+
+        @functools.wraps(method)
+        def traced(*a, **k):
+            with TRACER.span(jobid or 'controller', name, 'job'):
+                return method(*a, **k)
+        return self._pool.simple_job(traced, args, kwargs, jobid=jobid, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+def traced_hook(hook):
+    """
+    Decorates a plugin's run/on_add_node/on_remove_node: instruments the
+    nodes it is handed, records the hook itself and saves the trace
+    """
+    @functools.wraps(hook)
+    def wrapper(self, *args, **kwargs):
+        if not TRACER.enabled:
+            return hook(self, *args, **kwargs)
+        for arg in args:
+            for node in (arg if isinstance(arg, list) else [arg]):
+                if hasattr(node, 'ssh'):
+                    instrument(node)
+        name = '%s.%s' % (self.__class__.__name__, hook.__name__)
+        try:
+            with TRACER.span('controller', name, 'plugin'):
+                return hook(self, *args, **kwargs)
+        finally:
+            TRACER.save()
+    return wrapper
@@ -29,6 +29,13 @@ Next you need to mount the image::
     $ mount -t devpts none /tmp/img-mount/dev/pts
     $ mount -o rbind /var/run/dbus /tmp/img-mount/var/run/dbus
 
+Every command's output and a timeline of the build are written to
+/var/log/scimage; to keep them, bind a directory of the host there, otherwise
+they are removed with the other build leftovers once the build succeeds::
+
+    $ mkdir -p /tmp/scimage-logs /tmp/img-mount/var/log/scimage
+    $ mount -o bind /tmp/scimage-logs /tmp/img-mount/var/log/scimage
+
 Copy /etc/resolv.conf and /etc/mtab to the image::
 
     $ mkdir -p /tmp/img-mount/var/run/resolvconf
@@ -44,14 +51,22 @@ Finally chroot inside the image and run this script:
     $ chroot /tmp/img-mount /bin/bash
     $ cd $HOME
     $ python scimage.py
+
+To also bake in the Hadoop, Spark and Skylark installs of the setup plugins,
+copy the plugins directory next to the script and run it with --with-stack.
 """
 
 import os
+import re
 import sys
 import glob
+import json
+import time
 import shutil
-import fileinput
+import itertools
+import threading
 import subprocess
+import collections
 import multiprocessing
 
 SRC_DIR = "/usr/local/src"
@@ -63,6 +78,31 @@ GRID_SCHEDULER_GIT = 'git://github.com/jtriley/gridscheduler.git'
 CLOUDERA_ARCHIVE_KEY = 'http://archive.cloudera.com/debian/archive.key'
 CLOUDERA_APT = 'http://archive.cloudera.com/debian squeeze-cdh3u5 contrib'
 PPAS = ["ppa:staticfloat/julia-deps", "ppa:staticfloat/julianightlies"]
+TRACE_EVENTS = []
+# --with-stack bakes the Hadoop, Spark and Skylark installs of the plugins in
+# STACK_PLUGINS_DIR into the image, so clusters started from it only need to
+# be configured
+STACK_PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'plugins')
+STARCLUSTER_VERSION = '0.95.6'
+# the plugins import starcluster, which is installed here for the bake only
+# and removed by cleanup, so the controller-side tool stays out of the image
+STACK_STARCLUSTER_DIR = "/tmp/scimage-starcluster"
+# independent build steps run concurrently, but apt and dpkg hold a lock on
+# the package database so every apt/dpkg command is serialized behind
+# APT_LOCK; concurrent pip installs could race on shared dependencies
+MAX_PARALLEL_STEPS = 4
+# steps that must run alone: condor removes /var/lock
+SERIAL_STEPS = ['condor']
+APT_LOCK = threading.RLock()
+PIP_LOCK = threading.RLock()
+# every command's output is streamed to its own log file here; only the last
+# OUTPUT_TAIL_LINES lines are kept in memory
+COMMAND_LOG_DIR = "/var/log/scimage"
+TRACE_FILE = os.path.join(COMMAND_LOG_DIR, "trace.json")
+OUTPUT_TAIL_LINES = 200
+OUTPUT_LOCK = threading.Lock()
+_command_ids = itertools.count(1)
 STARCLUSTER_MOTD = """\
 #!/bin/sh
 cat<<"EOF"
@@ -107,61 +147,153 @@ landscape-sysinfo | grep -iv 'graph this data'
 """
 
 
+def trace_event(name, start, end, cat='command', **args):
+    TRACE_EVENTS.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': 1,
+                         'tid': threading.current_thread().ident,
+                         'ts': int(start * 1e6),
+                         'dur': int((end - start) * 1e6), 'args': args})
+
+
+def write_trace(path=TRACE_FILE):
+    """Writes the recorded steps and commands as Chrome trace-event JSON"""
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+             'args': {'name': 'scimage'}}]
+    with open(path, 'w') as fout:
+        json.dump({'traceEvents': meta + TRACE_EVENTS,
+                   'displayTimeUnit': 'ms'}, fout)
+    print ">>> Wrote build trace to %s" % path
+
+
+class CommandFailed(Exception):
+    def __init__(self, cmd, retval, tail, logfile):
+        self.cmd = cmd
+        self.retval = retval
+        self.tail = tail
+        self.logfile = logfile
+        Exception.__init__(
+            self, "command '%s' failed with status %d; last %d lines of "
+            "output (all of it is in %s):\n%s" % (cmd, retval, len(tail),
+                                                 logfile, ''.join(tail)))
+
+
+def _command_log(name):
+    if not os.path.isdir(COMMAND_LOG_DIR):
+        try:
+            os.makedirs(COMMAND_LOG_DIR)
+        except OSError:
+            pass  # created by a step running alongside
+    name = re.sub(r'[^\w.-]+', '_', name.strip())[:48]
+    return os.path.join(COMMAND_LOG_DIR,
+                        '%04d-%s.log' % (next(_command_ids), name))
+
+
+def _pump(stream, logfile, tail, counts, lock):
+    for line in iter(stream.readline, ''):
+        with lock:
+            logfile.write(line)
+            tail.append(line)
+            counts[0] += len(line)
+        with OUTPUT_LOCK:
+            sys.stdout.write(line)
+    stream.close()
+
+
 def run_command(cmd, ignore_failure=False, failure_callback=None,
-                get_output=False):
-    kwargs = {}
-    if get_output:
-        kwargs.update(dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE))
-    p = subprocess.Popen(cmd, shell=True, **kwargs)
-    output = []
-    if get_output:
-        line = None
-        while line != '':
-            line = p.stdout.readline()
-            if line != '':
-                output.append(line)
-                print line,
-        for line in p.stderr.readlines():
-            if line != '':
-                output.append(line)
-                print line,
-    retval = p.wait()
+                get_output=False, cwd=None, shell='/bin/sh', name=None):
+    """
+    Runs cmd in shell. stdout and stderr are read concurrently, echoed and
+    written to a per-command log in COMMAND_LOG_DIR; get_output returns, and
+    failures report, only the last OUTPUT_TAIL_LINES lines. name labels the
+    log and the trace event instead of cmd
+    """
+    start = time.time()
+    name = name or cmd
+    logpath = _command_log(name)
+    p = subprocess.Popen(cmd, shell=True, executable=shell, cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    counts = [0]
+    lock = threading.Lock()
+    with open(logpath, 'w') as logfile:
+        logfile.write('$ %s\n' % cmd)
+        readers = [threading.Thread(target=_pump,
+                                    args=(stream, logfile, tail, counts, lock))
+                   for stream in (p.stdout, p.stderr)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        for reader in readers:
+            reader.join()
+        retval = p.wait()
+    trace_event(name.strip().split('\n')[0][:80], start, time.time(), command=cmd,
+                exit_status=retval, cwd=cwd or os.getcwd(), bytes=counts[0],
+                log=logpath)
     if retval != 0:
         errmsg = "command '%s' failed with status %d" % (cmd, retval)
         if failure_callback:
             ignore_failure = failure_callback(retval)
         if not ignore_failure:
-            raise Exception(errmsg)
+            raise CommandFailed(cmd, retval, list(tail), logpath)
         else:
             sys.stderr.write(errmsg + '\n')
     if get_output:
-        return retval, ''.join(output)
+        return retval, ''.join(tail)
     return retval
 
 
-def apt_command(cmd):
+def stack_command(cmd, cwd, name):
+    """
+    Runs the commands of the plugins' install code, through LocalNode, with
+    the same logs, trace events and output tail as the rest of the build
+    """
+    retval, output = run_command(cmd, ignore_failure=True, get_output=True,
+                                 cwd=cwd, shell='/bin/bash', name=name)
+    return retval, output.splitlines()
+
+
+def apt_command(cmd, cwd=None):
     dpkg_opts = "Dpkg::Options::='--force-confnew'"
     cmd = "apt-get -o %s -y --force-yes %s" % (dpkg_opts, cmd)
     cmd = "DEBIAN_FRONTEND='noninteractive' " + cmd
-    run_command(cmd)
+    with APT_LOCK:
+        run_command(cmd, cwd=cwd)
 
 
 def apt_install(pkgs):
     apt_command('install %s' % pkgs)
 
 
-def chdir(directory):
+def dpkg_command(cmd, **kwargs):
+    """run_command for anything else that touches the package database"""
+    with APT_LOCK:
+        return run_command(cmd, **kwargs)
+
+
+def pip_command(cmd, **kwargs):
+    with PIP_LOCK:
+        return run_command(cmd, **kwargs)
+
+
+def rewrite_file(path, transform):
+    # unlike fileinput's inplace mode this leaves sys.stdout alone, so steps
+    # running alongside can keep printing
+    with open(path) as fin:
+        lines = fin.readlines()
+    with open(path, 'w') as fout:
+        fout.writelines(transform(lines))
+
+
+def find_dir(directory):
     opts = glob.glob(directory)
     isdirlist = [o for o in opts if os.path.isdir(o)]
     if len(isdirlist) > 1:
         raise Exception("more than one dir matches: %s" % directory)
-    os.chdir(isdirlist[0])
+    return isdirlist[0]
 
 
 def _fix_atlas_rules(rules_file='debian/rules'):
-    for line in fileinput.input(rules_file, inplace=1):
-        if 'ATLAS=None' not in line:
-            print line,
+    rewrite_file(rules_file,
+                 lambda lines: [l for l in lines if 'ATLAS=None' not in l])
 
 
 def configure_apt_sources():
@@ -183,10 +315,10 @@ def configure_apt_sources():
         srcfile.write('deb %s\n' % CLOUDERA_APT)
         srcfile.write('deb-src %s\n' % CLOUDERA_APT)
     run_command('gpg --keyserver keyserver.ubuntu.com --recv-keys 0F932C9C')
-    run_command('curl -s %s | sudo apt-key add -' % CLOUDERA_ARCHIVE_KEY)
+    dpkg_command('curl -s %s | sudo apt-key add -' % CLOUDERA_ARCHIVE_KEY)
     apt_install('debian-archive-keyring')
     for ppa in PPAS:
-        run_command('add-apt-repository %s -y -s' % ppa)
+        dpkg_command('add-apt-repository %s -y -s' % ppa)
 
 
 def upgrade_packages():
@@ -202,30 +334,29 @@ def install_java():
     apt_install('openjdk-7-jre')
 
 def install_gridscheduler():
-    chdir(SRC_DIR)
     apt_command('build-dep gridengine')
-    if os.path.isfile('gridscheduler-scbuild.tar.gz'):
-        run_command('tar xvzf gridscheduler-scbuild.tar.gz')
-        run_command('mv gridscheduler /opt/sge6-fresh')
+    if os.path.isfile(os.path.join(SRC_DIR, 'gridscheduler-scbuild.tar.gz')):
+        run_command('tar xvzf gridscheduler-scbuild.tar.gz', cwd=SRC_DIR)
+        run_command('mv gridscheduler /opt/sge6-fresh', cwd=SRC_DIR)
         return
-    run_command('git clone %s' % GRID_SCHEDULER_GIT)
+    run_command('git clone %s' % GRID_SCHEDULER_GIT, cwd=SRC_DIR)
     sts, out = run_command('readlink -f `which java`', get_output=True)
     java_home = out.strip().split('/jre')[0]
-    chdir(os.path.join(SRC_DIR, 'gridscheduler', 'source'))
-    run_command('git checkout -t -b develop origin/develop')
+    src = os.path.join(SRC_DIR, 'gridscheduler', 'source')
+    run_command('git checkout -t -b develop origin/develop', cwd=src)
     env = 'JAVA_HOME=%s' % java_home
-    run_command('%s ./aimk -only-depend' % env)
-    run_command('%s scripts/zerodepend' % env)
-    run_command('%s ./aimk depend' % env)
-    run_command('%s ./aimk -no-secure -no-gui-inst -man' % env)
+    run_command('%s ./aimk -only-depend' % env, cwd=src)
+    run_command('%s scripts/zerodepend' % env, cwd=src)
+    run_command('%s ./aimk depend' % env, cwd=src)
+    run_command('%s ./aimk -no-secure -no-gui-inst -man' % env, cwd=src)
     sge_root = '/opt/sge6-fresh'
     os.mkdir(sge_root)
     env += ' SGE_ROOT=%s' % sge_root
-    run_command('%s scripts/distinst -all -local -noexit -y -- man' % env)
+    run_command('%s scripts/distinst -all -local -noexit -y -- man' % env,
+                cwd=src)
 
 
 def install_condor():
-    chdir(SRC_DIR)
     run_command("rm -f /var/lock")
     #apt_install('condor=7.7.2-1')
     #run_command('echo condor hold | dpkg --set-selections')
@@ -238,33 +369,30 @@ def install_condor():
 
 
 def install_pydrmaa():
-    chdir(SRC_DIR)
-    run_command('pip install drmaa')
+    pip_command('pip install drmaa', cwd=SRC_DIR)
 
 
 def install_atlas():
     """docstring for install_atlas"""
-    chdir(SRC_DIR)
     apt_command('build-dep atlas')
-    if glob.glob("*atlas*.deb"):
-        run_command('dpkg -i *atlas*.deb')
+    if glob.glob(os.path.join(SRC_DIR, "*atlas*.deb")):
+        dpkg_command('dpkg -i *atlas*.deb', cwd=SRC_DIR)
         return
-    apt_command('source atlas')
-    chdir('atlas-*')
-    run_command('fakeroot debian/rules custom')
-    run_command('dpkg -i ../*atlas*.deb')
+    apt_command('source atlas', cwd=SRC_DIR)
+    src = find_dir(os.path.join(SRC_DIR, 'atlas-*'))
+    run_command('fakeroot debian/rules custom', cwd=src)
+    dpkg_command('dpkg -i ../*atlas*.deb', cwd=src)
 
 
 def install_openblas():
     """docstring for install_openblas"""
-    chdir(SRC_DIR)
     apt_command('build-dep libopenblas-dev')
-    if glob.glob("*openblas*.deb"):
-        run_command('dpkg -i *openblas*.deb')
+    if glob.glob(os.path.join(SRC_DIR, "*openblas*.deb")):
+        dpkg_command('dpkg -i *openblas*.deb', cwd=SRC_DIR)
     else:
-        apt_command('source libopenblas-dev')
-        chdir('openblas-*')
-        rule_file = open('Makefile.rule', 'a')
+        apt_command('source libopenblas-dev', cwd=SRC_DIR)
+        src = find_dir(os.path.join(SRC_DIR, 'openblas-*'))
+        rule_file = open(os.path.join(src, 'Makefile.rule'), 'a')
         # NO_AFFINITY=1 is required to utilize all cores on all non
         # cluster-compute/GPU instance types due to the shared virtualization
         # layer not supporting processor affinity properly. However, Cluster
@@ -277,10 +405,10 @@ def install_openblas():
                  'NO_AFFINITY=1']
         rule_file.write('\n'.join(lines))
         rule_file.close()
-        run_command('fakeroot debian/rules custom')
-        run_command('dpkg -i ../*openblas*.deb')
-    run_command('echo libopenblas-base hold | dpkg --set-selections')
-    run_command('echo libopenblas-dev hold | dpkg --set-selections')
+        run_command('fakeroot debian/rules custom', cwd=src)
+        dpkg_command('dpkg -i ../*openblas*.deb', cwd=src)
+    dpkg_command('echo libopenblas-base hold | dpkg --set-selections')
+    dpkg_command('echo libopenblas-dev hold | dpkg --set-selections')
     run_command("ldconfig")
 
 
@@ -292,78 +420,76 @@ def install_python_packages():
     apt_command('build-dep python-imaging')
     pkgs = "virtualenv pillow boto matplotlib django mpi4py Cython "
     pkgs += "pudb supervisor "
-    run_command("pip install %s" % pkgs)
+    pip_command("pip install %s" % pkgs)
 
 
 def install_numpy_scipy():
     """docstring for install_numpy"""
-    chdir(SRC_DIR)
     apt_command('build-dep python-numpy')
     apt_command('build-dep python-scipy')
-    run_command('pip install -d . numpy')
-    run_command('tar xvzf numpy*.tar.gz')
-    run_command("sed -i 's/return None #/pass #/' numpy*/numpy/core/setup.py")
-    run_command("cd numpy* && python setup.py install")
-    run_command('pip install scipy')
+    pip_command('pip install -d . numpy', cwd=SRC_DIR)
+    run_command('tar xvzf numpy*.tar.gz', cwd=SRC_DIR)
+    run_command("sed -i 's/return None #/pass #/' numpy*/numpy/core/setup.py",
+                cwd=SRC_DIR)
+    pip_command("cd numpy* && python setup.py install", cwd=SRC_DIR)
+    pip_command('pip install scipy', cwd=SRC_DIR)
 
 
 def install_pandas():
     """docstring for install_pandas"""
-    chdir(SRC_DIR)
     apt_command('build-dep pandas')
-    run_command('pip install pandas')
+    pip_command('pip install pandas', cwd=SRC_DIR)
 
 
 def install_openmpi():
-    chdir(SRC_DIR)
     apt_command('build-dep openmpi')
     apt_install('blcr-util')
-    if glob.glob('*openmpi*.deb'):
-        run_command('dpkg -i *openmpi*.deb')
+    if glob.glob(os.path.join(SRC_DIR, '*openmpi*.deb')):
+        dpkg_command('dpkg -i *openmpi*.deb', cwd=SRC_DIR)
     else:
-        apt_command('source openmpi')
-        chdir('openmpi*')
-        for line in fileinput.input('debian/rules', inplace=1):
-            print line,
-            if '--enable-heterogeneous' in line:
-                print '                        --with-sge \\'
+        apt_command('source openmpi', cwd=SRC_DIR)
+        src = find_dir(os.path.join(SRC_DIR, 'openmpi*'))
+        def _add_sge(lines):
+            for line in lines:
+                yield line
+                if '--enable-heterogeneous' in line:
+                    yield '                        --with-sge \\\n'
+        rewrite_file(os.path.join(src, 'debian/rules'), _add_sge)
 
         def _deb_failure_callback(retval):
-            if not glob.glob('../*openmpi*.deb'):
+            if not glob.glob(os.path.join(SRC_DIR, '*openmpi*.deb')):
                 return False
             return True
         run_command('dch --local=\'+custom\' '
-                    '"custom build on: `uname -s -r -v -m -p -i -o`"')
-        run_command('dpkg-buildpackage -rfakeroot -b',
+                    '"custom build on: `uname -s -r -v -m -p -i -o`"', cwd=src)
+        run_command('dpkg-buildpackage -rfakeroot -b', cwd=src,
                     failure_callback=_deb_failure_callback)
-        run_command('dpkg -i ../*openmpi*.deb')
+        dpkg_command('dpkg -i ../*openmpi*.deb', cwd=src)
     sts, out = run_command('ompi_info | grep -i grid', get_output=True)
     if 'gridengine' not in out:
         raise Exception("failed to build OpenMPI with "
                         "Open Grid Scheduler support")
-    run_command('echo libopenmpi1.3 hold | dpkg --set-selections')
-    run_command('echo libopenmpi-dev hold | dpkg --set-selections')
-    run_command('echo libopenmpi-dbg hold | dpkg --set-selections')
-    run_command('echo openmpi-bin hold | dpkg --set-selections')
-    run_command('echo openmpi-checkpoint hold | dpkg --set-selections')
-    run_command('echo openmpi-common hold | dpkg --set-selections')
-    run_command('echo openmpi-doc hold | dpkg --set-selections')
+    dpkg_command('echo libopenmpi1.3 hold | dpkg --set-selections')
+    dpkg_command('echo libopenmpi-dev hold | dpkg --set-selections')
+    dpkg_command('echo libopenmpi-dbg hold | dpkg --set-selections')
+    dpkg_command('echo openmpi-bin hold | dpkg --set-selections')
+    dpkg_command('echo openmpi-checkpoint hold | dpkg --set-selections')
+    dpkg_command('echo openmpi-common hold | dpkg --set-selections')
+    dpkg_command('echo openmpi-doc hold | dpkg --set-selections')
     run_command('ldconfig')
 
 
 def install_hadoop():
-    chdir(SRC_DIR)
     hadoop_pkgs = ['namenode', 'datanode', 'tasktracker', 'jobtracker',
                    'secondarynamenode']
     pkgs = ['hadoop-0.20'] + ['hadoop-0.20-%s' % pkg for pkg in hadoop_pkgs]
     apt_install(' '.join(pkgs))
-    run_command('easy_install dumbo')
+    pip_command('easy_install dumbo')
 
 
 def install_ipython():
-    chdir(SRC_DIR)
     apt_install('libzmq-dev')
-    run_command('pip install ipython[parallel,notebook]')
+    pip_command('pip install ipython[parallel,notebook]', cwd=SRC_DIR)
     # This is broken in IPy 1.1.0
     #mjax_install = 'from IPython.external.mathjax import install_mathjax'
     #mjax_install += '; install_mathjax()'
@@ -397,16 +523,18 @@ def configure_motd():
 
 
 def configure_bash():
-    completion_line_found = False
-    for line in fileinput.input('/etc/bash.bashrc', inplace=1):
-        if 'bash_completion' in line and line.startswith('#'):
-            print line.replace('#', ''),
-            completion_line_found = True
-        elif completion_line_found:
-            print line.replace('#', ''),
-            completion_line_found = False
-        else:
-            print line,
+    def _uncomment_completion(lines):
+        completion_line_found = False
+        for line in lines:
+            if 'bash_completion' in line and line.startswith('#'):
+                yield line.replace('#', '')
+                completion_line_found = True
+            elif completion_line_found:
+                yield line.replace('#', '')
+                completion_line_found = False
+            else:
+                yield line
+    rewrite_file('/etc/bash.bashrc', _uncomment_completion)
     aliasfile = open('/root/.bash_aliases', 'w')
     aliasfile.write("alias ..='cd ..'\n")
     aliasfile.close()
@@ -422,7 +550,6 @@ def setup_environ():
 
 
 def install_nfs():
-    chdir(SRC_DIR)
     run_command('initctl reload-configuration')
     apt_install('nfs-kernel-server')
     run_command('ln -s /etc/init.d/nfs-kernel-server /etc/init.d/nfs')
@@ -440,7 +567,7 @@ mysql-server mysql-server/root_password_again seen true
     """
     mysqlpreseed.write(preseeds)
     mysqlpreseed.close()
-    run_command('debconf-set-selections < %s' % mysqlpreseed.name)
+    dpkg_command('debconf-set-selections < %s' % mysqlpreseed.name)
     run_command('rm %s' % mysqlpreseed.name)
     pkgs = "git vim mercurial subversion cvs encfs keychain screen tmux zsh "
     pkgs += "ksh csh tcsh ec2-api-tools ec2-ami-tools mysql-server "
@@ -450,6 +577,23 @@ mysql-server mysql-server/root_password_again seen true
     apt_install(pkgs)
 
 
+def install_stack():
+    pip_command('pip install --target %s starcluster==%s'
+                % (STACK_STARCLUSTER_DIR, STARCLUSTER_VERSION))
+    sys.path.insert(0, STACK_STARCLUSTER_DIR)
+    sys.path.insert(0, STACK_PLUGINS_DIR)
+    import localnode
+    import myhadoop
+    import skylark_installer
+    import sparkinstaller
+    node = localnode.LocalNode(package_lock=APT_LOCK, pip_lock=PIP_LOCK,
+                               run=stack_command)
+    # Spark is built against the Hadoop installed first
+    myhadoop.HadoopInstaller(apt_proxy=False).bake_image(node)
+    sparkinstaller.SparkInstaller().bake_image(node)
+    skylark_installer.SkylarkInstaller(apt_proxy=False).bake_image(node)
+
+
 def configure_init():
     scripts = ['nfs-kernel-server', 'hadoop', 'condor', 'apache', 'mysql',
                'nginx']
@@ -470,38 +614,131 @@ def cleanup():
             shutil.rmtree(path)
     run_command('rm -f /var/cache/apt/archives/*.deb')
     run_command('rm -f /var/cache/apt/archives/partial/*')
+    run_command('rm -rf %s' % STACK_STARCLUSTER_DIR)
     for f in glob.glob('/etc/profile.d'):
         if 'byobu' in f:
             run_command('rm -f %s' % f)
     if os.path.islink('/sbin/initctl') and os.path.isfile('/sbin/initctl.bak'):
         run_command('mv -f /sbin/initctl.bak /sbin/initctl')
+    # unless they are kept outside the image
+    if not os.path.ismount(COMMAND_LOG_DIR):
+        shutil.rmtree(COMMAND_LOG_DIR, ignore_errors=True)
 
 
-def main():
-    """docstring for main"""
-    if os.getuid() != 0:
-        sys.stderr.write('you must be root to run this script\n')
-        return
-    setup_environ()
-    configure_motd()
-    configure_bash()
-    configure_apt_sources()
-    upgrade_packages()
-    install_build_utils()
-    #install_nfs()
-    install_default_packages()
-    install_python_packages()
+def run_steps(steps, max_parallel=MAX_PARALLEL_STEPS, durations=None,
+              serial=SERIAL_STEPS):
+    """
+    Runs (name, function, dependencies) steps, each as soon as its
+    dependencies have finished and at most max_parallel at a time. The
+    steps named in serial only start once nothing else is running and
+    nothing else starts until they have finished. Once a
+    step fails no new ones are started and the first failure is re-raised
+    after the running steps finish. Fills in and returns durations, each
+    step's duration in seconds
+    """
+    pending = list(steps)
+    running = set()
+    done = set()
+    if durations is None:
+        durations = {}
+    failures = []
+    cond = threading.Condition()
+
+    def worker(name, func):
+        start = time.time()
+        try:
+            func()
+            ok = True
+        except Exception:
+            ok = False
+            with cond:
+                failures.append(sys.exc_info())
+        end = time.time()
+        trace_event(name, start, end, cat='step', ok=ok)
+        with OUTPUT_LOCK:
+            print ">>> %s %s in %.1fs" % (name, 'done' if ok else 'FAILED',
+                                          end - start)
+        with cond:
+            durations[name] = end - start
+            running.discard(name)
+            if ok:
+                done.add(name)
+            cond.notify_all()
+
+    with cond:
+        while True:
+            for step in list(pending):
+                name, func, deps = step
+                if failures or len(running) >= max_parallel:
+                    break
+                if running.intersection(serial):
+                    break
+                if all(dep in done for dep in deps):
+                    if name in serial and running:
+                        # let the running steps drain first
+                        break
+                    pending.remove(step)
+                    running.add(name)
+                    thread = threading.Thread(target=worker, args=(name, func))
+                    thread.daemon = True
+                    thread.start()
+            if not running:
+                break
+            cond.wait()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    if pending:
+        raise Exception("steps with unmet dependencies: %s" %
+                        ', '.join(name for name, func, deps in pending))
+    return durations
+
+
+def build_steps(with_stack=False):
     # Only use these to build the packages locally
     # These should normally be installed from the PPAs
     #install_openblas()
     #install_openmpi()
     #install_julia()
-    install_java()
-    install_gridscheduler()
-    install_condor()
-    install_hadoop()
-    configure_init()
-    cleanup()
+    #install_nfs()
+    steps = [
+        ('environ', setup_environ, []),
+        ('motd', configure_motd, []),
+        ('bash', configure_bash, []),
+        ('apt_sources', configure_apt_sources, ['environ']),
+        ('upgrade', upgrade_packages, ['apt_sources']),
+        ('build_utils', install_build_utils, ['upgrade']),
+        ('default_packages', install_default_packages, ['upgrade']),
+        ('java', install_java, ['upgrade']),
+        ('python_packages', install_python_packages,
+         ['build_utils', 'default_packages']),
+        ('gridscheduler', install_gridscheduler,
+         ['build_utils', 'default_packages', 'java']),
+        ('condor', install_condor, ['upgrade']),
+        ('hadoop', install_hadoop, ['build_utils']),
+    ]
+    if with_stack:
+        steps.append(('stack', install_stack,
+                      ['build_utils', 'default_packages', 'java']))
+    steps.append(('init', configure_init, [name for name, f, d in steps]))
+    steps.append(('cleanup', cleanup, ['init']))
+    return steps
+
+
+def main():
+    """docstring for main"""
+    if os.getuid() != 0:
+        sys.stderr.write('you must be root to run this script\n')
+        return
+    durations = {}
+    try:
+        run_steps(build_steps('--with-stack' in sys.argv), durations=durations)
+    finally:
+        # cleanup removes the log directory unless it is outside the image
+        if os.path.isdir(COMMAND_LOG_DIR):
+            write_trace()
+        with OUTPUT_LOCK:
+            for name, seconds in sorted(durations.items(), key=lambda d: -d[1]):
+                print ">>> %-20s %8.1fs" % (name, seconds)
 
 if __name__ == '__main__':
     main()